@@ -10,7 +10,7 @@ from sklearn.linear_model import LogisticRegression, LinearRegression
 from sklearn.model_selection import train_test_split
 from sklearn.cluster import AgglomerativeClustering, KMeans
 from sklearn import preprocessing
-from sklearn.metrics import f1_score, roc_auc_score, jaccard_similarity_score
+from sklearn.metrics import f1_score, roc_auc_score
 from IPython.core.display import HTML
 from IPython.display import clear_output
 import numpy.ma as ma # masking package
@@ -32,6 +32,12 @@ from plotnine import *
 import plotnine
 import matplotlib as mp
 
+# counts store
+from scanpy_helpers import create_adata_store, append_anno_indexed, join_cell_metadata, fused_qc_filter, \
+                           classify_features, process_adata, classify_type, pca_adata, \
+                           scan_res, StageCache, TaskGraph, task_shared, class_labels, subset_rows, \
+                           LazySubset, cluster_louvain, PlotRenderer, draw_embedding
+
 # uniprot api
 from bioservices import UniProt
 u = UniProt()
@@ -178,23 +184,6 @@ def append_anno (adata, anno, anno_dict):
     # summary
     sum_output (adata)
 
-def remove_ercc (adata):
-    # Remove ercc spike-in
-    # Input: adata obj
-    # Output: updated adata obj
-    
-    print('Remove ERCC genes...')
-    
-    gene_names = adata.var_names.tolist()
-    ERCC_hits = list(filter(lambda x: 'ERCC' in x, gene_names))
-    adata = adata[:, [x for x in gene_names if not (x in ERCC_hits)]]
-    
-    # summary
-    print('Filtered genes: {}'.format(len(ERCC_hits)))    
-    sum_output (adata)
-    
-    return adata
-
 def technical_filters (adata, min_genes=500,min_counts=50000,min_cells=3):
     # remove cells/genes based on low quality
     # input: adata
@@ -210,76 +199,6 @@ def technical_filters (adata, min_genes=500,min_counts=50000,min_cells=3):
     print('\tResult:')   
     sum_output (adata)
 
-def process_adata (adata, 
-                  min_mean=0.0125, 
-                  max_mean=10, 
-                  min_disp=0.1):
-    # Add cell and gene filters, perform data scale/transform
-    # Input: adata obj + filter options (below)
-    # Output: updated adata obj
-    
-    print('Process expression data...')
-    print('\tInitial:')
-    sum_output(adata)
-
-    print('min mean expression (min_mean): {}'.format(min_mean))
-    print('max mean expression (max_mean)): {}'.format(max_mean))
-    print('min dispresion (min_disp): {}'.format(min_disp))
-    
-    # normalize counts per cell
-    tmp = sc.pp.normalize_per_cell(adata, copy=True)
-    
-    # filter cells based on min genes and min counts cutoff
-    filter_result = sc.pp.filter_genes_dispersion(tmp.X, 
-                                                  min_mean=min_mean, 
-                                                  max_mean=max_mean, 
-                                                  min_disp=min_disp)
-    tmp = tmp[:, filter_result.gene_subset]
-    
-    # log transform expression
-    sc.pp.log1p(tmp)
-    
-    # regress out total counts
-#     sc.pp.regress_out(tmp, ['n_counts'])
-#     print('REGRESSION ON')
-    
-    # mean-center and unit variance scaling
-    sc.pp.scale(tmp)
-    
-    # summary
-    print('Filtered cells: {}'.format(len(adata.obs) - len(tmp.obs)))
-    print('Filtered genes: {}'.format(len(adata.var_names) - len(tmp.var_names)))
-    print('\tResult:')
-    sum_output (tmp)
-    
-    return tmp
-
-def pca_adata (adata, num_pcs=None, hoods=30):
-    # Perform PCA dimensionality reduction + plot variance explained
-    # Input: adata obj
-    # Output: updated adata obj + print plot
-    
-    print('Principle component analysis...')
-    
-    # Perform PCA
-    sc.tl.pca(adata)
-    adata.obsm['X_pca'] *= -1  # multiply by -1 to match Seurat
-    sc.pl.pca_variance_ratio(adata, log=True)
-    
-    # Neigbhor graph
-    if num_pcs is None:
-        print('Enter number of principle components to use:')
-        input1=input()
-        try:
-            num_pcs = int(input1)
-        except Exception as e:
-            print(e)
-            print('Using default settings')
-            num_pcs=15
-    
-    print('principle_components(num_pcs): {}\ncells/neighborhood(hoods): {}'.format(num_pcs, hoods))
-    sc.pp.neighbors(adata,n_pcs=num_pcs, n_neighbors=hoods)
-
 def umap_adata (adata, res=None):
     # Perform clustering and UMAP
     # Input: adata obj + cluster options (below)
@@ -311,96 +230,6 @@ def umap_adata (adata, res=None):
     sc.tl.louvain(adata, resolution = res)
     sc.pl.umap(adata, color=['louvain'], legend_loc='on data')
     
-def subset_adata (adata, feature_dict):
-    # Subset adata obj by user dictionary of features and values list. Filter operation below:
-        # level1: value1 | value2 | value3...
-        # level2: key1 & key2 & key3...
-    # Input: raw_adata obj + dictionary of feature:[value1, value2...]
-    # Output: subsetted adata obj
-    
-    input_adata = adata
-    stack_len = len(input_adata.obs)
-    subset_arr = np.zeros((len(feature_dict), stack_len))
-    
-    print('Subsetting data...')
-    
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(input_adata.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        subset_arr[key_count, :] = subset_value
-        key_count += 1
-        
-    subset_list = np.product(subset_arr, axis = 0, dtype='bool')    
-    input_adata = input_adata[subset_list,:]
-    sum_output (input_adata)
-    
-    return input_adata
-
-def subset_adata_v2 (raw, subset, feature_dict):
-    # Subset adata obj by user dictionary of features and values list. Filter operation below:
-        # level1: value1 | value2 | value3...
-        # level2: key1 & key2 & key3...
-    # Input: raw_adata obj + subsetted ad obj + dictionary of feature:[value1, value2...]
-    # Output: subsetted adata obj
-    
-    input_adata = subset
-    stack_len = len(input_adata.obs)
-    subset_arr = np.zeros((len(feature_dict), stack_len))
-    
-    print('Subsetting data...')
-    
-    # subset the subset
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(input_adata.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        subset_arr[key_count, :] = subset_value
-        key_count += 1
-        
-    subset_list = np.product(subset_arr, axis = 0, dtype='bool')    
-    input_adata = input_adata[subset_list,:]
-    
-    # match cell names with raw
-    matches = [True if x in input_adata.obs_names.tolist() else False for x in raw.obs_names.tolist()]
-    output_adata = raw[matches,:] 
-    sum_output (output_adata)
-    
-    return output_adata
-
-def subset_adata_v3 (raw, feature_dict):
-    stack_len = len(raw)
-    bool_arr = np.zeros((len(feature_dict), stack_len))
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(raw.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        bool_arr[key_count, :] = subset_value
-        key_count += 1
-    subset_list = np.product(bool_arr, axis = 0, dtype='bool')    
-    output_adata = raw[subset_list,:] 
-    sum_output (output_adata)
-    
-    return output_adata    
-    
 def class2continuous_reg (X, y, test_size = 0.33):
     # Linear regression and returns R2
     # Input: list/array of predictors (categorical = str) and list of responses (float)
@@ -452,103 +281,6 @@ def class2class_reg (X, y, test_size=0.33):
     
     return acc
 
-def scan_res(input_adata, step_size=0.05):
-    # Scan through resolution setting for Louvain clustering and return similarity to previous step. Used to determine resolution setting.
-    # Input: ad obj + step size (optional; float)
-    # Output: print plot
-    
-    print('\tresolution_interval(step_size): {}'.format(step_size))
-    
-    basis_point = int(step_size * 100)
-    
-    # compute clusters
-    df = pd.DataFrame()
-    res_list = [x/100 for x in range(basis_point,100,basis_point)]
-    for res in res_list:
-        tmp = input_adata
-        sc.tl.louvain(tmp, resolution = res)
-        df['res_{}'.format(res)] = tmp.obs['louvain']
-    
-    # plot cluster occupancies
-    res_vals = df.columns.tolist()
-    base_df = (df.groupby(df.columns.tolist()[0]).size()
-                    .reset_index()
-                    .rename({0:'count',
-                             df.columns.tolist()[0]:'group_2'}, axis='columns'))
-    base_df['group_1'] = base_df['group_2']
-    base_df['step'] = res_vals[0]
-    base_df['ncounts'] = base_df['count']/base_df['count'].sum()
-    
-    for idx,x in enumerate(range(2,len(df.columns.tolist())+1,1)):
-        columns_oi = df.columns.tolist()[(x-2):x]
-        tmp = (df.groupby(columns_oi)
-                .size()
-                .reset_index()
-                .rename({0:'count', 
-                         columns_oi[0]:'group_1',
-                         columns_oi[1]:'group_2'}, axis='columns'))
-        tmp['step'] = res_vals[idx+1]
-        tmp['ncounts'] = tmp['count']/tmp['count'].sum()
-        base_df = base_df.append(tmp)
-
-    groupcat1 = CategoricalDtype(['{}'.format(x) for x in range(len(set(base_df['group_1'])))],ordered=True)
-    base_df['group_1_cat'] = base_df['group_1'].astype(str).astype(groupcat1)
-    groupcat2 = CategoricalDtype(['{}'.format(x) for x in range(len(set(base_df['group_2'])))],ordered=True)
-    base_df['group_2_cat'] = base_df['group_2'].astype(str).astype(groupcat2)
-
-    plotnine.options.figure_size = (8,8)
-    print(ggplot(base_df)
-            +theme_bw()
-            +theme(aspect_ratio=1)
-            +geom_bar(aes('group_2_cat','ncounts',fill='group_1_cat'),stat='identity')
-            +facet_wrap('~step')
-            +labs(x='current label', y='proportion of cells', fill='previous label'))
-    
-    # plot max Jaccard index for each pair of resolutions
-    # convert to int for addition operation
-    for col in df.columns.tolist():
-        df[col] = df[col].astype(int)
-
-    # return max jaccard index value over n+1 label iterator
-    jidx_list = []
-    for idx, col in enumerate(res_vals):
-        if idx > 0:
-            ref = df[res_vals[idx-1]].tolist()
-            curr = df[res_vals[idx]].tolist()
-
-            poss_labs = list(set(ref+curr))
-            jidx_poss = [jaccard_similarity_score(ref, curr)]
-            for idx, x in enumerate(range(len(poss_labs)-1)):
-                reset_val = max(poss_labs)
-                ref = [(x+1) if (x <= reset_val) else 0 for x in ref]
-                jidx_poss.append(jaccard_similarity_score(ref, curr))
-            jidx_list.append(max(jidx_poss))
-    jidx_df = pd.DataFrame({'jidx':jidx_list, 'res':res_vals[1:]})
-    
-    plotnine.options.figure_size = (3,3)
-    print(ggplot(jidx_df)
-             +theme_bw()
-             +theme(aspect_ratio=1,
-                    axis_text_x=element_text(angle=90))
-             +geom_bar(aes('res','jidx'), stat='identity')
-             +labs(y='Jaccard index (rel. to prev. res.)',x='current res.'))
-    
-def classify_type(raw_adata, clustered_adata, input_class, type_dict, output_class):
-    # Manually classify
-    # Input: raw ad obj (unfiltered) + ad obj with cluster assignments + dict of labels:cluster assignment + colname
-    # Output: update raw ad obj in place
-    
-    type_list = ['unknown'] * len(raw_adata.obs)
-    
-    for key,value in type_dict.items():
-        clustered_names = [name for cluster,name in zip(clustered_adata.obs[input_class], 
-                                                             clustered_adata.obs_names) if cluster in value]  
-        value_idx = [idx for idx,x in enumerate(raw_adata.obs_names) if x in clustered_names]
-        for x in value_idx:
-            type_list[x] = key
-            
-    raw_adata.obs[output_class] = type_list
-    
 def rank_genes (input_adata, methods=['wilcoxon','t-test_overestim_var'],n_genes=20, groupby='louvain'):
     # Rank genes
     # Input: ad obj
@@ -692,11 +424,11 @@ def occupancy(input_adata, elements, group):
          labs(y='fraction of elements',x=''))
 
 
-def main():
-    # download data from s3
-    wkdir = '/home/ubuntu/data/DL20181011_melanocyte_test_data'
-    s3dir = 'daniel.le-work/MEL_project'
-
+def stage_ingest(wkdir, markers):
+    # ingestion stage: annotations + counts store + QC
+    # Input: data dir + marker genes
+    # Output: filtered raw adata w/ frozen log1p raw
+    
     # read annotation data
     anno = pd.read_csv('{}/primary_mel_metadata_181011.csv'.format(wkdir), index_col=0)
     anno = anno.loc[:, ['nGenes', 'nReads', 'well', 'plate', 'patient_id']]
@@ -709,134 +441,178 @@ def main():
     plate_df = plate_df.loc[:, ['plate_barcode', 'patient_id', 'sample_color', 'age', 
                                 'age_bin', 'sex','race', 'general_location', 'anatomical_location']]
 
-    # update metadata with merge
-    merged_anno = pd.merge(anno, plate_df, 'left', ['plate_barcode', 'patient_id'])
-
-
-    # append bsc metadata to anno
+    # bsc metadata
     bsc = pd.read_csv('{}/DL20181106_bsc_metadata.csv'.format(wkdir))
-    merged_anno = pd.merge(merged_anno,bsc,'left',['well','plate_barcode'])
-    merged_anno = merged_anno.set_index('cell_name')
 
-    # read raw data (expression data) to pandas df
-    pre_adata = pd.read_csv('{}/primary_mel_rawdata_181011.csv'.format(wkdir), index_col=0)
-    pre_adata.columns = merged_anno.index.tolist()
-    pre_adata = pre_adata.rename_axis('gene_name')
-
-    # markers
-    markers = ['PMEL','KRT1','KRT5','KRT10','TYR','MITF']
+    # update metadata: plate and bsc lookups joined onto cells in one pass
+    merged_anno = join_cell_metadata(anno, [(plate_df, ['plate_barcode', 'patient_id']),
+                                            (bsc, ['well', 'plate_barcode'])])
+    merged_anno = merged_anno.set_index('cell_name')
 
-    # ingest data
-    raw_adata = create_adata(pre_adata)
-    raw_adata.var['ribo'] = raw_adata.var_names.str.startswith(('RPL','RPS'))
-    raw_adata.var['ercc'] = np.array([True if 'ERCC' in x else False for x in raw_adata.var_names.tolist()])
-    sc.pp.calculate_qc_metrics(raw_adata, feature_controls=['ribo','ercc'], inplace=True)
+    # ingest data (memory-mapped counts store, built from the raw CSV on first run)
+    raw_adata = create_adata_store('{}/primary_mel_rawdata_181011_store'.format(wkdir),
+                                   csv_path='{}/primary_mel_rawdata_181011.csv'.format(wkdir),
+                                   dtype=np.float32)
+    raw_adata.obs_names = merged_anno.index.tolist()
+    classify_features(raw_adata) # var ercc/ribo/mito masks
+    # anno column:obs column, aligned by cell name; string fields stored as categoricals
     anno_dict = {'age':'age',
                  'age_bin':'age_bin',
-                 'plate':'plate_barcode',
+                 'plate_barcode':'plate',
                  'general_location':'general_location',
                  'anatomical_location':'anatomical_location',
                  'race':'race',
                  'sex':'sex',
-                 'color':'sample_color',
-                 'patient':'patient_id',
-                 'bsc': 'bsc_a'}
-    append_anno(raw_adata, merged_anno, anno_dict)
+                 'sample_color':'color',
+                 'patient_id':'patient',
+                 'bsc_a':'bsc'}
+    append_anno_indexed(raw_adata, merged_anno, anno_dict)
     append_markers(raw_adata, gene_markers=markers)
-    technical_filters(raw_adata)
+    raw_adata = fused_qc_filter(raw_adata, feature_controls=['ribo','ercc']) # QC metrics + filters, one pass
     # raw_adata = remove_ercc(raw_adata) 
     raw_adata.raw = sc.pp.log1p(raw_adata, copy=True) # freeze raw state
-
-    # all-cells analysis
-    full_adata = process_adata(raw_adata)
-    pca_adata(full_adata, num_pcs=16)
-    umap_adata(full_adata, res=0.3)
-
-    # classify in raw adata
-    input_adata = full_adata
-
-    MEL_int = [0,1,2,4]
-    KRT_int = [x for x in range(len(input_adata.obs['louvain'].cat.categories)) if x not in MEL_int]
+    return raw_adata
+
+def task_cluster(feature_dict, num_pcs, res, labels=None):
+    # pool task: subset shared raw adata (all cells if feature_dict is None) + process + PCA + Louvain
+    # Input: subset features + PCA/Louvain settings + class labels from upstream tasks (col:array over raw obs)
+    # Output: (clustered adata, labels)
+    raw_adata = task_shared()
+    labels = labels or {}
+    obs_idx = np.arange(raw_adata.n_obs)
+    if feature_dict is None:
+        adata = raw_adata
+    else:
+        obs_idx = subset_rows(raw_adata.obs.assign(**labels), feature_dict)
+        adata = LazySubset(raw_adata, obs_idx=obs_idx)
+    adata = process_adata(adata)
+    for col, values in labels.items(): # subsets carry the class columns, as subset_adata_v2 did
+        adata.obs[col] = np.asarray(values)[obs_idx]
+    pca_adata(adata, num_pcs=num_pcs, headless=True)
+    cluster_louvain(adata, res)
+    return adata, labels
+
+def task_embed(clustered, plot_dir=None, scan=True):
+    # pool task: UMAP of a clustered adata; off the critical path
+    # Input: task_cluster output + dir for plot images (background renderer; None skips plots)
+        # scan = also run the resolution scan diagnostics (warm-started sweep, as umap_adata's scan_res)
+    # Output: dict of X_umap (+ scan stability df if scan)
+    adata, _ = clustered
+    renderer = PlotRenderer(plot_dir) if plot_dir else None
+    result = {}
+    if scan:
+        # serial warm sweep: pool workers cannot start their own pool
+        result['stability'] = scan_res(adata, warm_start=True, headless=True, renderer=renderer)['stability']
+    sc.tl.umap(adata)
+    if renderer is not None:
+        renderer.submit('umap', draw_embedding, np.array(adata.obsm['X_umap']), np.array(adata.obs['louvain']))
+        renderer.close()
+    result['X_umap'] = adata.obsm['X_umap']
+    return result
+
+def task_full():
+    return task_cluster(None, 16, 0.3)
+
+def task_subset1(full, age_bins, MEL_int):
+    # classify all-cells clusters as MEL/KRT, recluster adult MEL cells
+    full_adata, labels = full
+    KRT_int = [x for x in range(len(full_adata.obs['louvain'].cat.categories)) if x not in MEL_int]
     type_dict = {'KRT':[str(x) for x in KRT_int],
                  'MEL':[str(x) for x in MEL_int]}
-
-    classify_type(raw_adata, input_adata, 'louvain', type_dict, 'class_1')
-
-    # remove non-Adult bins
-    age_bins = raw_adata.obs['age_bin'].unique()
-    for feat in ['FET_12WK','NEO']:
-        age_bins = age_bins[age_bins != feat]
-
-    feature_dict = {'age_bin':age_bins.tolist(), 'class_1':['MEL']}
-    adata_subset1 = subset_adata_v3(raw_adata,feature_dict)
-    adata_subset1 = process_adata(adata_subset1)
-    pca_adata(adata_subset1, num_pcs=7)
-    umap_adata(adata_subset1, res=0.1)
-
-    # cull cells using Tukey outlier threshold
+    labels = dict(labels, class_1=class_labels(task_shared(), full_adata, 'louvain', type_dict))
+    feature_dict = {'age_bin':age_bins, 'class_1':['MEL']}
+    return task_cluster(feature_dict, 7, 0.1, labels=labels)
+
+def task_outliers(subset1, threshold):
+    # cull cells using Tukey outlier threshold on every PC
+    # Output: 'outlier'/'ingroup' per subset1 cell
+    adata_subset1, _ = subset1
     df = pd.DataFrame(adata_subset1.obsm['X_pca'])
-    df.columns = ['PC_{}'.format(x) for x in range(50)]
-
-    omit_names = []
-    for pc in df.columns:
-    #     print(len(set(omit_names)))
-        Q1 = df[pc].quantile(0.25)
-        Q3 = df[pc].quantile(0.75)
-        IQR = Q3 - Q1
-        threshold=7
-
-        bool_idx = [True if ((Q1 - threshold * IQR) <= x <= (Q3 + threshold * IQR)) else False for x in df[pc]]
-        filtered = df[bool_idx]
-    #     print('Filtered cells: ', len(df)-len(filtered))
-
-        omit_names = omit_names + adata_subset1.obs[[not x for x in bool_idx]].index.tolist()
-
-    print('Filtered cells: ', len(set(omit_names)))
-    test = raw_adata[[x for x in raw_adata.obs.index if x not in set(omit_names)]]
-
-    # check where the outliers lie in original projection
-    input_adata = adata_subset1
-    input_adata.obs['outliers'] = ['outlier' if x in set(omit_names) else 'ingroup' for x in input_adata.obs.index]
-
-    # outliers on all-cells projection
-    input_adata = adata_subset1
-
-    type_dict = {'ingroup':['ingroup'],
-                 'outlier':['outlier']}
-
-    classify_type(full_adata, input_adata, 'outliers', type_dict, 'outliers')
-
-    # classify
-    input_adata = adata_subset1
-
+    Q1 = df.quantile(0.25)
+    Q3 = df.quantile(0.75)
+    IQR = Q3 - Q1
+    inside = ((Q1 - threshold * IQR) <= df) & (df <= (Q3 + threshold * IQR))
+    outliers = np.where(inside.all(axis=1), 'ingroup', 'outlier')
+    print('Filtered cells: ', (outliers == 'outlier').sum())
+    return pd.Series(outliers, index=adata_subset1.obs_names)
+
+def task_subset2(subset1, outliers, age_bins):
+    # recluster adult MEL cells sans outliers
+    adata_subset1, labels = subset1
+    adata_subset1.obs['outliers'] = outliers
     type_dict = {'ingroup':['ingroup'],
                  'outlier':['outlier']}
+    labels = dict(labels, class_2=class_labels(task_shared(), adata_subset1, 'outliers', type_dict))
+    feature_dict = {'age_bin':age_bins, 'class_1':['MEL'], 'class_2':['ingroup']}
+    return task_cluster(feature_dict, 30, .5, labels=labels)
 
-    classify_type(raw_adata, input_adata, 'outliers', type_dict, 'class_2')
+def task_subset3(subset2, age_bins):
+    # recluster the main adult MEL clusters
+    adata_subset2, labels = subset2
+    type_dict = {'main':['0','1'],
+                 'outer':['2','3','4']}
+    labels = dict(labels, class_3=class_labels(task_shared(), adata_subset2, 'louvain', type_dict))
+    feature_dict = {'age_bin':age_bins, 
+                    'class_1':['MEL'], 
+                    'class_3':['main']}
+    return task_cluster(feature_dict, 30, .4, labels=labels)
 
-    # recluster
-    feature_dict = {'age_bin':age_bins.tolist(), 'class_1':['MEL'], 'class_2':['ingroup']}
-    adata_subset2 = subset_adata_v3(raw_adata, feature_dict)
-    adata_subset2 = process_adata(adata_subset2)
-    pca_adata(adata_subset2, num_pcs=30)
-    umap_adata(adata_subset2, res=.5)
+def main(use_cache=True, ncores=4, scan=True):
+    # scan = resolution scan diagnostics in each UMAP task (adata.uns['scan_stability']); False skips them
+    # download data from s3
+    wkdir = '/home/ubuntu/data/DL20181011_melanocyte_test_data'
+    s3dir = 'daniel.le-work/MEL_project'
 
-    # classify
-    input_adata = adata_subset2
+    # stage checkpoints: keyed by input files, parameters and upstream stages
+    stages = StageCache('{}/stage_cache'.format(wkdir) if use_cache else None)
+    input_files = ['{}/{}'.format(wkdir, x) for x in ['primary_mel_metadata_181011.csv',
+                                                      'DL20181107_metadata_update.csv',
+                                                      'DL20181106_bsc_metadata.csv',
+                                                      'primary_mel_rawdata_181011.csv']]
 
-    type_dict = {'main':['0','1'],
-                 'outer':['2','3','4']}
+    # markers
+    markers = ['PMEL','KRT1','KRT5','KRT10','TYR','MITF']
 
-    classify_type(raw_adata, input_adata, 'louvain', type_dict, 'class_3')
+    raw_adata = stages.run('ingest', stage_ingest, wkdir, markers, files=input_files)
 
-    # recluster
-    feature_dict = {'age_bin':age_bins.tolist(), 
-                    'class_1':['MEL'], 
-                    'class_3':['main']}
-    adata_subset3 = subset_adata_v3(raw_adata, feature_dict)
-    adata_subset3 = process_adata(adata_subset3)
-    pca_adata(adata_subset3, num_pcs=30)
-    umap_adata(adata_subset3, res=.4)
+    # remove non-Adult bins
+    age_bins = raw_adata.obs['age_bin'].unique()
+    for feat in ['FET_12WK','NEO']:
+        age_bins = age_bins[age_bins != feat]
+    age_bins = age_bins.tolist()
+
+    # analysis graph: each recluster depends only on the labels of the previous one,
+    # UMAP (+ optional scan) diagnostics branch off and run alongside the next recluster
+    graph = TaskGraph()
+    graph.add('full', task_full)
+    plot_dir = '{}/plots'.format(wkdir)
+    graph.add('full_umap', task_embed, '{}/full'.format(plot_dir), scan, deps=['full'])
+    graph.add('subset1', task_subset1, age_bins, [0,1,2,4], deps=['full'])
+    graph.add('subset1_umap', task_embed, '{}/subset1'.format(plot_dir), scan, deps=['subset1'])
+    graph.add('outliers', task_outliers, 7, deps=['subset1'])
+    graph.add('subset2', task_subset2, age_bins, deps=['subset1', 'outliers'])
+    graph.add('subset2_umap', task_embed, '{}/subset2'.format(plot_dir), scan, deps=['subset2'])
+    graph.add('subset3', task_subset3, age_bins, deps=['subset2'])
+    graph.add('subset3_umap', task_embed, '{}/subset3'.format(plot_dir), scan, deps=['subset3'])
+    results = graph.run(ncores=ncores, shared=raw_adata, stages=stages, shared_deps=['ingest'])
+
+    full_adata, adata_subset1, adata_subset2, adata_subset3 = [results[x][0] for x in ['full', 'subset1',
+                                                                                      'subset2', 'subset3']]
+    for name, adata in zip(['full', 'subset1', 'subset2', 'subset3'],
+                           [full_adata, adata_subset1, adata_subset2, adata_subset3]):
+        adata.obsm['X_umap'] = results['{}_umap'.format(name)]['X_umap']
+        if scan:
+            adata.uns['scan_stability'] = results['{}_umap'.format(name)]['stability']
+
+    # write class labels back to raw adata
+    for col, values in results['subset3'][1].items():
+        raw_adata.obs[col] = values
+
+    # outliers on subset + all-cells projection
+    adata_subset1.obs['outliers'] = results['outliers']
+    type_dict = {'ingroup':['ingroup'],
+                 'outlier':['outlier']}
+    classify_type(full_adata, adata_subset1, 'outliers', type_dict, 'outliers')
     clear_output()
     
     return full_adata, adata_subset1, adata_subset2, adata_subset3
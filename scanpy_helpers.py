@@ -9,18 +9,23 @@ import scipy.stats as ss
 from sklearn.linear_model import LogisticRegression, LinearRegression
 from sklearn.model_selection import train_test_split
 from sklearn.cluster import AgglomerativeClustering, KMeans
+from sklearn.neighbors import NearestNeighbors
 from sklearn import preprocessing
-from sklearn.metrics import f1_score, roc_auc_score, jaccard_similarity_score
+from sklearn.metrics import f1_score, roc_auc_score
 from IPython.core.display import HTML
 import numpy.ma as ma # masking package
 import statsmodels.api as sm
 import random
-import subprocess, os, sys, mygene, string, glob
+import subprocess, os, sys, mygene, string, glob, time, multiprocessing, shutil, gzip, resource, tempfile, queue
 import pickle
 import tqdm
 from itertools import combinations, permutations
 import s3fs
 import boto3
+import hashlib
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 # sc analysis
 import scanpy.api as sc
@@ -136,11 +141,15 @@ def sum_output (adata):
     # Output: print out
     print('\tCells: {}, Genes: {}'.format(len(adata.obs), len(adata.var_names)))
 
-def create_adata (pre_adata):
+def create_adata (pre_adata, streaming=False, chunksize=2000, dtype=np.int32):
     # Creates adata obj from raw data (rows=gene_names, col=cell_id)
-    # Input: raw expression data in pd df
+    # Input: raw expression data in pd df (or CSV path/chunk iterator if streaming=True)
+        # dtype = X dtype when streaming (a float dtype for non-integer tables)
     # Output: adata obj
-    
+
+    if streaming == True:
+        return create_adata_streaming(pre_adata, chunksize=chunksize, dtype=dtype)
+
     print('Ingest raw data...')
 
     # pd df to np array
@@ -159,9 +168,87 @@ def create_adata (pre_adata):
     
     # summary
     sum_output (adata)
-    
+
     return adata
-    
+
+def iter_count_chunks (source, chunksize=2000):
+    # Yield gene x cell counts tables in row (gene) chunks
+    # Input: path to gene x cell CSV (index_col=0) or pd df or iterable of pd df chunks
+    # Output: generator of pd df chunks sharing the same cell columns
+
+    if isinstance(source, str):
+        for chunk in pd.read_csv(source, index_col=0, chunksize=chunksize):
+            yield chunk
+    elif isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source.iloc[start:start+chunksize]
+    else:
+        for chunk in source:
+            yield chunk
+
+def stream_counts_csr (source, chunksize=2000, dtype=np.int32):
+    # Build cell x gene CSR matrix from gene x cell counts without a dense intermediate
+    # Input: see iter_count_chunks + integer dtype of stored counts
+    # Output: (sparse csr cell x gene, list of gene names, list of cell names)
+
+    data_list = []
+    indices_list = []
+    row_nnz = []
+    gene_names = []
+    cell_names = None
+
+    for chunk in iter_count_chunks(source, chunksize=chunksize):
+        if cell_names is None:
+            cell_names = chunk.columns.tolist()
+        elif chunk.columns.tolist() != cell_names:
+            raise ValueError('cell columns differ between chunks')
+
+        # only the current chunk is ever dense
+        values = chunk.values
+        counts = values.astype(dtype)
+        if not np.array_equal(counts, values):
+            raise ValueError('non-integer counts found; use a float dtype instead')
+        gene_idx, cell_idx = np.nonzero(counts)
+
+        data_list.append(counts[gene_idx, cell_idx])
+        indices_list.append(cell_idx.astype(np.int32))
+        row_nnz.append(np.bincount(gene_idx, minlength=len(chunk)))
+        gene_names = gene_names + chunk.index.tolist()
+
+    if cell_names is None:
+        raise ValueError('no counts found in source')
+
+    # gene x cell CSR assembled row block by row block, transposed view is cell x gene CSC
+    indptr = np.zeros(len(gene_names)+1, dtype=np.int64)
+    np.cumsum(np.concatenate(row_nnz), out=indptr[1:])
+    gene_by_cell = sparse.csr_matrix((np.concatenate(data_list),
+                                      np.concatenate(indices_list),
+                                      indptr),
+                                     shape=(len(gene_names), len(cell_names)))
+    del data_list, indices_list
+
+    return gene_by_cell.T.tocsr(), gene_names, cell_names
+
+def create_adata_streaming (source, chunksize=2000, dtype=np.int32):
+    # Creates adata obj from raw data (rows=gene_names, col=cell_id) in gene chunks
+    # Input: path to counts CSV, pd df or iterable of pd df chunks + chunk size + integer dtype
+    # Output: adata obj with integer sparse X; peak memory tracks nnz, not cells x genes
+
+    print('Ingest raw data (streaming)...')
+
+    X, gene_names, cell_names = stream_counts_csr(source, chunksize=chunksize, dtype=dtype)
+
+    # create ad obj
+    adata = ad.AnnData(X=X,
+                       obs=pd.DataFrame(index=cell_names),
+                       var=pd.DataFrame({'gene_symbols':gene_names}, index=gene_names),
+                       dtype=X.dtype)
+
+    # summary
+    sum_output (adata)
+
+    return adata
+
 def append_anno (adata, anno, anno_dict):
     # Add annotations of choice from annotation file
     # input = adata obj + dictionary of label and column name (with respect to annotation df) + anno pd df
@@ -179,6 +266,59 @@ def append_anno (adata, anno, anno_dict):
     # summary
     sum_output (adata)
 
+def append_anno_indexed (adata, anno, anno_dict, categorical=True):
+    # Add annotations aligned by cell name (anno index == adata.obs_names) instead of by position
+    # input = adata obj + anno pd df indexed by cell name + dictionary of anno column:obs column
+    #         + store string columns as categoricals (list of obs columns, True for all, False for none)
+    # output = updated adata obj
+
+    print('Append annotations (indexed)...')
+
+    if not anno.index.is_unique:
+        raise ValueError('annotation index has duplicate cell names')
+    missing = (~adata.obs_names.isin(anno.index)).sum()
+    if missing > 0:
+        print('\t{} cells without annotation'.format(missing))
+
+    # one hash lookup for all columns
+    aligned = anno.loc[:, list(anno_dict.keys())].reindex(adata.obs_names)
+    for key,value in anno_dict.items():
+        col = aligned[key]
+        as_cat = (value in categorical) if isinstance(categorical, (list, tuple, set)) else categorical
+        if as_cat == True and not pd.api.types.is_numeric_dtype(col):
+            col = col.astype('category')
+        adata.obs[value] = col.values
+
+    # summary
+    sum_output (adata)
+
+def join_cell_metadata (cells, lookups, categorical=False):
+    # Join per-plate/per-well lookup tables onto per-cell metadata in one pass (replaces chained left merges)
+    # Input: per-cell pd df + list of (lookup pd df, list of key columns) + cast string columns to categoricals
+    # Output: pd df with cells' rows/order and lookup columns aligned by key (missing keys -> NaN)
+
+    joined = cells.copy()
+    for table, keys in lookups:
+        lookup = table.set_index(keys)
+        if not lookup.index.is_unique:
+            raise ValueError('lookup keys {} are not unique'.format(keys))
+        probe = pd.MultiIndex.from_frame(joined[keys]) if len(keys) > 1 else pd.Index(joined[keys[0]])
+        aligned = lookup.reindex(probe)
+        for col in aligned.columns:
+            # same column naming as pd.merge for overlapping names
+            if col in joined.columns:
+                joined = joined.rename(columns={col:'{}_x'.format(col)})
+                joined['{}_y'.format(col)] = aligned[col].values
+            else:
+                joined[col] = aligned[col].values
+
+    if categorical == True:
+        for col in joined.columns:
+            if not pd.api.types.is_numeric_dtype(joined[col]):
+                joined[col] = joined[col].astype('category')
+
+    return joined
+
 def remove_ercc (adata):
     # Remove ercc spike-in
     # Input: adata obj
@@ -186,16 +326,64 @@ def remove_ercc (adata):
     
     print('Remove ERCC genes...')
     
-    gene_names = adata.var_names.tolist()
-    ERCC_hits = list(filter(lambda x: 'ERCC' in x, gene_names))
-    adata = adata[:, [x for x in gene_names if not (x in ERCC_hits)]]
+    n_genes = len(adata.var_names)
+    adata = drop_features(adata, ['ercc'])
     
     # summary
-    print('Filtered genes: {}'.format(len(ERCC_hits)))    
+    print('Filtered genes: {}'.format(n_genes - len(adata.var_names)))
     sum_output (adata)
     
     return adata
 
+# feature class name: gene name prefixes (ERCC- so ERCC1-8 repair genes are not taken for spike-ins)
+feature_prefixes = {'ercc':['ERCC-'],
+                    'ribo':['RPL','RPS'],
+                    'mito':['MT-']}
+
+def feature_class_mask (names, prefixes=None, genes=None):
+    # Vectorized bool mask of gene names matching any prefix or listed gene
+    # Input: gene names (list/index) + list of prefixes + list of genes
+    # Output: np bool array
+    names = pd.Index(names)
+    mask = np.zeros(len(names), dtype=bool)
+    if prefixes:
+        mask |= np.asarray(names.str.startswith(tuple(prefixes)), dtype=bool)
+    if genes is not None:
+        mask |= names.isin(genes)
+    return mask
+
+def classify_features (adata, prefixes=None, gene_lists=None, overwrite=False):
+    # Cache feature class masks as bool adata.var columns (definitions kept in adata.uns['feature_classes'])
+    # Input: adata obj + dict of class:prefixes (default feature_prefixes) + dict of class:gene list
+    # Output: updated adata obj in place; classes already cached with the same definition are skipped
+    prefixes = feature_prefixes if prefixes is None else prefixes
+    gene_lists = {} if gene_lists is None else gene_lists
+    cached = dict(adata.uns.get('feature_classes', {}))
+
+    for name in list(prefixes.keys()) + [x for x in gene_lists.keys() if x not in prefixes]:
+        definition = {'prefixes':list(prefixes.get(name, [])),
+                      'genes':sorted(gene_lists.get(name, []))}
+        if overwrite == False and name in adata.var.columns and cached.get(name) == definition:
+            continue
+        adata.var[name] = feature_class_mask(adata.var_names,
+                                             prefixes=definition['prefixes'],
+                                             genes=definition['genes'] if name in gene_lists else None)
+        cached[name] = definition
+
+    adata.uns['feature_classes'] = cached
+
+def drop_features (adata, classes):
+    # Remove all features in any of the given classes with one column slice
+    # Input: adata obj + list of class names (computed with defaults if not cached)
+    # Output: subsetted adata obj
+    missing = [x for x in classes if x not in adata.var.columns]
+    if len(missing) > 0:
+        classify_features(adata, prefixes={x:feature_prefixes[x] for x in missing})
+    drop = np.zeros(adata.n_vars, dtype=bool)
+    for name in classes:
+        drop |= adata.var[name].values.astype(bool)
+    return adata[:, ~drop]
+
 def technical_filters (adata, min_genes=500,min_counts=50000,min_cells=3):
     # remove cells/genes based on low quality
     # input: adata
@@ -211,13 +399,76 @@ def technical_filters (adata, min_genes=500,min_counts=50000,min_cells=3):
     print('\tResult:')   
     sum_output (adata)
 
+def qc_metrics_csr (X, feature_masks=None):
+    # Per-cell detected genes, total counts and per-feature-class counts from the CSR buffers
+    # Input: cell x gene matrix + dict of name:bool gene mask (e.g. ribo, ercc)
+    # Output: (n_genes array, n_counts array, dict of name:counts array)
+    X = X if sparse.isspmatrix_csr(X) else sparse.csr_matrix(X)
+    acc_dtype = np.float64 if X.dtype.kind == 'f' else np.int64
+    n_genes = np.diff(X.indptr)
+
+    # row sums straight from data/indptr; a trailing 0 keeps every start a valid index,
+    # empty rows (reduceat returns the element at start) are zeroed after
+    def row_sums(values):
+        sums = np.add.reduceat(np.append(values, 0), X.indptr[:-1], dtype=acc_dtype)
+        sums[n_genes == 0] = 0
+        return sums
+
+    n_counts = row_sums(X.data)
+    control_counts = {}
+    for name, mask in (feature_masks or {}).items():
+        control_counts[name] = row_sums(np.where(np.asarray(mask, dtype=bool)[X.indices], X.data, 0))
+
+    return n_genes, n_counts, control_counts
+
+def fused_qc_filter (adata, min_genes=500, min_counts=50000, min_cells=3, feature_controls=None):
+    # QC metrics + technical_filters thresholds in one sweep over X, then one row/column subset
+    # input: adata + thresholds as technical_filters + list of bool var columns to report (e.g. ['ribo','ercc'])
+    # output: filtered adata obj; obs n_genes, n_counts, total_counts_<ctrl>, pct_counts_<ctrl>; var n_cells
+    print('Remove low-quality cells/genes (fused)...')
+    print('\tInitial:')
+    sum_output (adata)
+
+    X = adata.X if sparse.isspmatrix_csr(adata.X) else sparse.csr_matrix(adata.X)
+    feature_masks = {name:adata.var[name].values for name in (feature_controls or [])}
+    n_genes, n_counts, control_counts = qc_metrics_csr(X, feature_masks)
+
+    cell_mask = (n_genes >= min_genes) & (n_counts >= min_counts)
+    # cells expressing each gene, counted over kept cells only (as filter_genes after filter_cells)
+    n_cells = np.bincount(X.indices[np.repeat(cell_mask, n_genes)], minlength=X.shape[1])
+    gene_mask = n_cells >= min_cells
+
+    adata.obs['n_genes'] = n_genes
+    adata.obs['n_counts'] = n_counts
+    for name, counts in control_counts.items():
+        adata.obs['total_counts_{}'.format(name)] = counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            adata.obs['pct_counts_{}'.format(name)] = np.where(n_counts > 0, 100 * counts / n_counts, 0)
+    adata.var['n_cells'] = n_cells
+
+    adata = adata[cell_mask, gene_mask].copy()
+
+    print('\tResult:')
+    sum_output (adata)
+
+    return adata
+
 def process_adata (adata, 
                   min_mean=0.0125, 
                   max_mean=10, 
-                  min_disp=0.1):
+                  min_disp=0.1,
+                  memory_budget=None,
+                  implicit_scale=False):
     # Add cell and gene filters, perform data scale/transform
-    # Input: adata obj + filter options (below)
+    # Input: adata obj (or LazySubset) + filter options (below)
+        # memory_budget = bytes or '16G'/'500M'; runs the float32 in-place mode (process_adata_budgeted)
+        # implicit_scale = keep X sparse log-normalized, store gene mean/std for pca_adata (no dense scale)
     # Output: updated adata obj
+
+    if memory_budget is not None:
+        return process_adata_budgeted(adata, memory_budget,
+                                      min_mean=min_mean, max_mean=max_mean, min_disp=min_disp,
+                                      implicit_scale=implicit_scale)
     
     print('Process expression data...')
     print('\tInitial:')
@@ -228,7 +479,12 @@ def process_adata (adata,
     print('min dispresion (min_disp): {}'.format(min_disp))
     
     # normalize counts per cell
-    tmp = sc.pp.normalize_per_cell(adata, copy=True)
+    if isinstance(adata, LazySubset):
+        # lazy subset: materialize once, normalize that fresh copy in place
+        tmp = adata.materialize()
+        sc.pp.normalize_per_cell(tmp)
+    else:
+        tmp = sc.pp.normalize_per_cell(adata, copy=True)
     
     # filter cells based on min genes and min counts cutoff
     filter_result = sc.pp.filter_genes_dispersion(tmp.X, 
@@ -245,7 +501,11 @@ def process_adata (adata,
 #     print('REGRESSION ON')
     
     # mean-center and unit variance scaling
-    sc.pp.scale(tmp)
+    if implicit_scale:
+        tmp = tmp.copy() if tmp.is_view else tmp
+        set_implicit_scale(tmp)
+    else:
+        sc.pp.scale(tmp)
     
     # summary
     print('Filtered cells: {}'.format(len(adata.obs) - len(tmp.obs)))
@@ -255,20 +515,902 @@ def process_adata (adata,
     
     return tmp
 
-def pca_adata (adata, num_pcs=None, hoods=30):
+def parse_bytes (size):
+    # '16G' / '512M' / '100K' / int bytes -> int bytes
+    if isinstance(size, str):
+        units = {'K':1<<10, 'M':1<<20, 'G':1<<30, 'T':1<<40}
+        size = size.strip().upper().rstrip('B')
+        if size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(float(size))
+    return int(size)
+
+def _proc_status_bytes (field):
+    # VmRSS / VmHWM line of /proc/self/status in bytes (Linux), None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss ():
+    # restart the kernel's peak RSS counter (VmHWM) from the current RSS; False where unsupported
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_bytes ():
+    # peak resident set size of this process since the last reset_peak_rss (Linux),
+    # otherwise over the whole process life (ru_maxrss)
+    peak = _proc_status_bytes('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _check_budget (stage, need, budget):
+    print('\t{}: est. {:.2f} GB of {:.2f} GB budget'.format(stage, need/1e9, budget/1e9))
+    if need > budget:
+        raise MemoryError('{} needs ~{:.2f} GB, over the {:.2f} GB budget'.format(stage, need/1e9, budget/1e9))
+
+def process_adata_budgeted (adata,
+                            memory_budget,
+                            min_mean=0.0125,
+                            max_mean=10,
+                            min_disp=0.1,
+                            implicit_scale=False):
+    # process_adata in float32 under a memory budget: normalize + log1p in place on the sparse .data
+    # of one CSR copy, HVG slice before log1p, dense only for the final scaling
+    # Input: adata obj or LazySubset + budget (bytes or '16G') + filter options as process_adata
+    # Output: processed adata obj (same steps as process_adata); MemoryError with estimate if over budget
+
+    budget = parse_bytes(memory_budget)
+    print('Process expression data (float32, budget {:.2f} GB of new allocations; '
+          'input adata not counted)...'.format(budget/1e9))
+    rss_start = _proc_status_bytes('VmRSS')
+    peak_reset = reset_peak_rss()
+    print('\tInitial:')
+    sum_output(adata)
+
+    print('min mean expression (min_mean): {}'.format(min_mean))
+    print('max mean expression (max_mean)): {}'.format(max_mean))
+    print('min dispresion (min_disp): {}'.format(min_disp))
+
+    if isinstance(adata, LazySubset):
+        src, rows, cols = adata.adata, adata.obs_idx, adata.var_idx
+    else:
+        src, rows, cols = adata, np.arange(adata.n_obs), np.arange(adata.n_vars)
+    src_X = src.X if sparse.isspmatrix_csr(src.X) else sparse.csr_matrix(src.X)
+
+    # stage 1: float32 CSR copy of selected rows + transient copy made by the dispersion filter
+    nnz = int(np.diff(src_X.indptr)[rows].sum())
+    csr_bytes = lambda n_nonzero, n_rows: n_nonzero * 8 + (n_rows + 1) * 8
+    _check_budget('normalize + dispersion', 2 * csr_bytes(nnz, len(rows)), budget)
+
+    X = src_X[rows]
+    if len(cols) != src_X.shape[1]:
+        X = X[:, cols]
+    X = X.astype(np.float32, copy=False)
+    X.sort_indices()
+
+    # normalize_per_cell: drop empty cells, scale each row to the median total, in place on .data
+    n_genes, n_counts, _ = qc_metrics_csr(X)
+    keep = n_counts > 0
+    if not keep.all():
+        X = X[keep]
+        n_genes, n_counts = n_genes[keep], n_counts[keep]
+    X.data *= np.repeat((np.median(n_counts) / n_counts).astype(np.float32), n_genes)
+
+    filter_result = sc.pp.filter_genes_dispersion(X,
+                                                  min_mean=min_mean,
+                                                  max_mean=max_mean,
+                                                  min_disp=min_disp)
+    hvg = np.flatnonzero(filter_result.gene_subset)
+
+    # stage 2: HVG slice (sparse) + dense float32 scaled matrix; full copy freed first
+    X = X[:, hvg]
+    dense_bytes = 0 if implicit_scale else X.shape[0] * len(hvg) * 4
+    _check_budget('log1p + scale', csr_bytes(X.nnz, X.shape[0]) + dense_bytes, budget)
+    np.log1p(X.data, out=X.data)
+
+    if implicit_scale:
+        dense = X
+    else:
+        # mean-center and unit variance scaling (ddof=1 as sc.pp.scale), float32 in place
+        dense = X.toarray()
+        del X
+        mean = dense.mean(axis=0, dtype=np.float64)
+        std = dense.std(axis=0, ddof=1, dtype=np.float64)
+        std[std == 0] = 1
+        dense -= mean.astype(np.float32)
+        dense /= std.astype(np.float32)
+
+    obs = src.obs.iloc[rows[keep]].copy()
+    obs['n_counts'] = n_counts.astype(np.float32)
+    tmp = ad.AnnData(X=dense,
+                     obs=obs,
+                     var=src.var.iloc[cols[hvg]].copy(),
+                     uns=dict(src.uns),
+                     dtype=np.float32)
+    if src.raw is not None:
+        tmp.raw = ad.AnnData(X=src.raw.X[rows[keep]],
+                             obs=pd.DataFrame(index=obs.index),
+                             var=src.raw.var.copy(),
+                             dtype=src.raw.X.dtype)
+    if implicit_scale:
+        set_implicit_scale(tmp)
+
+    # summary
+    print('Filtered cells: {}'.format(len(adata.obs) - len(tmp.obs)))
+    print('Filtered genes: {}'.format(len(adata.var_names) - len(tmp.var_names)))
+    if peak_reset and rss_start is not None:
+        peak = peak_rss_bytes()
+        print('\tPeak RSS: {:.2f} GB, {:+.2f} GB over the {:.2f} GB at start '
+              '(the budget covers this increase)'.format(peak/1e9, (peak - rss_start)/1e9, rss_start/1e9))
+    else:
+        print('\tPeak RSS: {:.2f} GB (process lifetime, may include earlier work)'.format(peak_rss_bytes()/1e9))
+    print('\tResult:')
+    sum_output (tmp)
+
+    return tmp
+
+def sparse_mean_std (X):
+    # per-column mean and std (ddof=1, float64) of a sparse or dense matrix without densifying
+    n = X.shape[0]
+    if sparse.issparse(X):
+        mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+        sq = np.asarray(X.multiply(X).sum(axis=0), dtype=np.float64).ravel()
+    else:
+        mean = X.mean(axis=0, dtype=np.float64)
+        sq = np.square(X, dtype=np.float64).sum(axis=0)
+    var = (sq - n * mean**2) / (n - 1)
+    return mean, np.sqrt(np.clip(var, 0, None))
+
+def set_implicit_scale (adata):
+    # record gene mean/std so PCA can center + scale implicitly; X stays sparse log-normalized
+    mean, std = sparse_mean_std(adata.X)
+    std[std == 0] = 1
+    adata.var['scale_mean'] = mean
+    adata.var['scale_std'] = std
+    adata.uns['implicit_scale'] = True
+
+def scaled_operator (X, mean, std):
+    # LinearOperator for (X - mean) / std; matvec/rmatvec never form the dense scaled matrix
+    from scipy.sparse.linalg import LinearOperator
+    inv_std = 1 / np.asarray(std, dtype=np.float64)
+    mean = np.asarray(mean, dtype=np.float64)
+
+    def matmat(B):
+        B = B.reshape(X.shape[1], -1) * inv_std[:, None]
+        return np.asarray(X @ B) - (mean @ B)[None, :]
+
+    def rmatmat(B):
+        B = B.reshape(X.shape[0], -1)
+        return (np.asarray(X.T @ B) - np.outer(mean, B.sum(axis=0))) * inv_std[:, None]
+
+    return LinearOperator(X.shape, dtype=np.float64,
+                          matvec=matmat, rmatvec=rmatmat,
+                          matmat=matmat, rmatmat=rmatmat)
+
+def randomized_svd_operator (A, n_comps, n_oversamples=10, n_iter=7, random_state=0):
+    # Halko et al. randomized SVD on a LinearOperator (power iterations w/ QR re-orthonormalization)
+    # Output: U, S, Vt with the sign convention of sklearn svd_flip (largest |U| entry positive)
+    rng = np.random.RandomState(random_state)
+    k = min(n_comps + n_oversamples, min(A.shape))
+    Q = rng.normal(size=(A.shape[1], k))
+    Q, _ = np.linalg.qr(A.matmat(Q))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(A.rmatmat(Q))
+        Q, _ = np.linalg.qr(A.matmat(Q))
+    B = A.rmatmat(Q).T
+    Uhat, S, Vt = np.linalg.svd(B, full_matrices=False)
+    U = (Q @ Uhat)[:, :n_comps]
+    S, Vt = S[:n_comps], Vt[:n_comps]
+
+    signs = np.sign(U[np.abs(U).argmax(axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+    return U * signs, S, Vt * signs[:, None]
+
+def pca_implicit (adata, n_comps=50, svd_solver='randomized', random_state=0):
+    # sc.tl.pca equivalent on implicitly centered + scaled sparse X (see set_implicit_scale)
+        # svd_solver = 'randomized' (default, as sc.tl.pca auto on large data) or 'arpack' (exact, slower)
+    # Output: obsm['X_pca'], varm['PCs'], uns['pca'] (variance, variance_ratio) as sc.tl.pca
+    X = adata.X if sparse.issparse(adata.X) else np.asarray(adata.X)
+    n_comps = min(n_comps, min(X.shape) - 1)
+    A = scaled_operator(X, adata.var['scale_mean'].values, adata.var['scale_std'].values)
+    if svd_solver == 'arpack':
+        from scipy.sparse.linalg import svds
+        v0 = np.random.RandomState(random_state).uniform(-1, 1, min(A.shape))
+        U, S, Vt = svds(A, k=n_comps, v0=v0)
+        order = np.argsort(-S)
+        U, S, Vt = U[:, order], S[order], Vt[order]
+        signs = np.sign(U[np.abs(U).argmax(axis=0), np.arange(U.shape[1])])
+        U, Vt = U * signs, Vt * signs[:, None]
+    else:
+        U, S, Vt = randomized_svd_operator(A, n_comps, random_state=random_state)
+
+    variance = S**2 / (X.shape[0] - 1)
+    _, std = sparse_mean_std(X)
+    total_var = np.sum((std / adata.var['scale_std'].values)**2)
+    adata.obsm['X_pca'] = (U * S).astype(np.float32)
+    adata.varm['PCs'] = Vt.T
+    adata.uns['pca'] = {'variance': variance, 'variance_ratio': variance / total_var}
+
+def pca_inputs (adata):
+    # matrix + centering/scaling vectors for operator PCA on processed adata
+    # implicit_scale: sparse log-normalized X w/ stored mean/std; otherwise X is already scaled
+    if adata.uns.get('implicit_scale', False):
+        return adata.X, adata.var['scale_mean'].values, adata.var['scale_std'].values
+    X = adata.X if sparse.issparse(adata.X) else np.asarray(adata.X)
+    mean, _ = sparse_mean_std(X)
+    return X, mean, np.ones(X.shape[1])
+
+def pc_elbow (variance_ratio):
+    # elbow of the explained variance curve: point farthest from the first-last chord
+    y = np.asarray(variance_ratio, dtype=np.float64)
+    if len(y) < 3:
+        return len(y)
+    x = np.linspace(0, 1, len(y))
+    y = (y - y.min()) / max(y.max() - y.min(), 1e-12)
+    dist = np.abs(y - (1 - x))  # chord from (0,1) to (1,0)
+    return int(dist.argmax()) + 1
+
+def permute_columns (X, cols, rng):
+    # copy of X with each column in cols independently shuffled across rows (sparse stays sparse)
+    n = X.shape[0]
+    perms = np.argsort(rng.random_sample((n, len(cols))), axis=0)
+    if not sparse.issparse(X):
+        Xp = np.array(X, copy=True)
+        block = np.empty_like(Xp[:, cols])
+        np.put_along_axis(block, perms, Xp[:, cols], axis=0)
+        Xp[:, cols] = block
+        return Xp
+    Xp = sparse.csc_matrix(X, copy=True)
+    for i, col in enumerate(cols):
+        start, end = Xp.indptr[col], Xp.indptr[col+1]
+        Xp.indices[start:end] = perms[Xp.indices[start:end], i]
+    Xp.has_sorted_indices = False
+    return Xp.tocsr()
+
+_jackstraw_ref = None
+
+def _init_jackstraw_worker(X, mean, std, n_comps, n_genes):
+    # Pool initializer: hand the processed matrix to each worker once
+    global _jackstraw_ref
+    _jackstraw_ref = (X, mean, std, n_comps, n_genes)
+
+def _jackstraw_worker(seed):
+    # Pool worker: permute a random gene subset, redo PCA, return |loadings| of permuted genes (PC x gene)
+    X, mean, std, n_comps, n_genes = _jackstraw_ref
+    rng = np.random.RandomState(seed)
+    genes = rng.choice(X.shape[1], n_genes, replace=False)
+    Xp = permute_columns(X, genes, rng)
+    _, _, Vt = randomized_svd_operator(scaled_operator(Xp, mean, std), n_comps, random_state=seed)
+    return np.abs(Vt[:, genes])
+
+def jackstraw_pcs (adata, n_comps=None, n_perm=100, prop_genes=0.01, score_thresh=1e-5, ncores=None, random_state=0):
+    # JackStraw (Chung & Storey; Seurat) significance of each PC, permutations run in a process pool
+    # Input: adata w/ PCA (varm['PCs']) + permutation options
+    # Output: per-PC p-values (binomial test of genes w/ empirical p <= score_thresh vs expected)
+    X, mean, std = pca_inputs(adata)
+    observed = np.abs(adata.varm['PCs'].T)
+    if n_comps is not None:
+        observed = observed[:n_comps]
+    n_comps, n_genes = observed.shape
+    n_perm_genes = max(3, int(round(prop_genes * n_genes)))
+
+    seeds = np.random.RandomState(random_state).randint(0, 2**31 - 1, n_perm)
+    start = time.time()
+    p = multiprocessing.Pool(processes=ncores,
+                             initializer=_init_jackstraw_worker,
+                             initargs=(X, mean, std, n_comps, n_perm_genes))
+    try:
+        null = np.hstack(p.map(_jackstraw_worker, seeds))
+    finally:
+        p.close()
+        p.join()
+    print('JackStraw: {} permutations in {:.1f}s'.format(n_perm, time.time() - start))
+
+    # empirical p of each observed loading against its PC's null, then binomial score per PC
+    null.sort(axis=1)
+    n_null = null.shape[1]
+    pc_pvals = []
+    for k in range(n_comps):
+        emp_p = (n_null - np.searchsorted(null[k], observed[k], side='left')) / n_null
+        n_sig = int((emp_p <= score_thresh).sum())
+        pc_pvals.append(ss.binom.sf(n_sig - 1, n_genes, score_thresh))
+    return np.array(pc_pvals)
+
+def select_n_pcs (adata, method='elbow', alpha=0.05, **jackstraw_kw):
+    # automatic PC count for pca_adata; result recorded in adata.uns['pc_selection']
+    # Input: adata w/ PCA + method ('elbow' or 'jackstraw') + alpha for JackStraw PC p-values
+    # Output: number of PCs (int)
+    variance_ratio = adata.uns['pca']['variance_ratio']
+    elbow = pc_elbow(variance_ratio)
+    record = {'method': method, 'elbow': elbow}
+    if method == 'elbow':
+        n_pcs = elbow
+    elif method == 'jackstraw':
+        pvals = jackstraw_pcs(adata, **jackstraw_kw)
+        # leading run of significant PCs
+        n_pcs = int(np.argmax(np.append(pvals >= alpha, True)))
+        record.update({'jackstraw_pvals': pvals, 'alpha': alpha})
+    else:
+        raise ValueError('method must be elbow or jackstraw, got {}'.format(method))
+    n_pcs = max(n_pcs, 2)
+    record['n_pcs'] = n_pcs
+    adata.uns['pc_selection'] = record
+    print('PC selection ({}): {} PCs'.format(method, n_pcs))
+    return n_pcs
+
+def array_fingerprint (*arrays):
+    # sha1 over shape, dtype and buffer contents of dense/sparse arrays
+    h = hashlib.sha1()
+    for x in arrays:
+        if sparse.issparse(x):
+            x = x.tocsr()
+            parts = [x.data, x.indices, x.indptr]
+        else:
+            x = np.asarray(x)
+            parts = [x]
+        h.update(str((x.shape, x.dtype.str, sparse.issparse(x))).encode())
+        for part in parts:
+            h.update(memoryview(np.ascontiguousarray(part)).cast('B'))
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    content-addressed on-disk cache of pickled results (PCA, neighbors, UMAP);
+    keys hash a data fingerprint + stage parameters, least recently used entries
+    are evicted once the directory exceeds max_bytes
+    """
+    def __init__(self, cache_dir, max_bytes='4G'):
+        self.cache_dir = cache_dir
+        self.max_bytes = parse_bytes(max_bytes)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, fingerprint, **params):
+        tag = '{}|{}|{}'.format(stage, fingerprint, sorted(params.items()))
+        return '{}-{}'.format(stage, hashlib.sha1(tag.encode()).hexdigest())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.pkl'.format(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)  # mark as recently used
+        return value
+
+    def put(self, key, value):
+        _replace_write(self._path(key), lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            os.remove(path)
+
+def as_result_cache (cache):
+    # None, cache dir path or ResultCache -> ResultCache or None
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(cache)
+
+def file_fingerprint (*paths):
+    # sha1 over path, size and mtime (ns) of input files; cheap stand-in for hashing contents
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}|{}|{}'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+def stage_repr (value):
+    # key text for a stage argument: content hash for arrays / pandas objects (their repr is
+    # truncated), element-wise for containers, repr for scalars and other short values
+    if isinstance(value, np.ndarray) or sparse.issparse(value):
+        return 'array:{}'.format(array_fingerprint(value))
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        return '{}:{}:{}'.format(type(value).__name__, labels,
+                                 array_fingerprint(pd.util.hash_pandas_object(value).values))
+    if isinstance(value, (list, tuple)):
+        return '{}({})'.format(type(value).__name__, ', '.join(stage_repr(x) for x in value))
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda kv: repr(kv[0]))
+        return '{{{}}}'.format(', '.join('{!r}: {}'.format(k, stage_repr(v)) for k, v in items))
+    return repr(value)
+
+class StageCache:
+    """
+    checkpoints for a multi-stage pipeline: each stage's output is stored in a ResultCache
+    under a key hashed from the stage name, its upstream stage keys, input file fingerprints
+    and its non-AnnData arguments (stage_repr), so a changed parameter recomputes only that stage and
+    everything downstream of it; cache_dir=None runs every stage
+    """
+    def __init__(self, cache_dir, max_bytes='50G'):
+        self.results = ResultCache(cache_dir, max_bytes=max_bytes) if cache_dir else None
+        self.keys = {}
+        self.timings = {}
+
+    def stage_key(self, name, args=(), deps=(), files=(), params=None, kwargs=None, fn=None):
+        parts = [self.keys[d] for d in deps] + [getattr(fn, '__name__', '')]
+        if files:
+            parts.append(file_fingerprint(*files))
+        arg_reprs = [stage_repr(a) for a in args if not isinstance(a, (ad.AnnData, LazySubset))]
+        kwarg_reprs = {k: stage_repr(v) for k, v in (kwargs or {}).items()}
+        key = ResultCache.key(name, '|'.join(parts), args=arg_reprs, params=stage_repr(params), **kwarg_reprs)
+        self.keys[name] = key
+        return key
+
+    def run(self, name, fn, *args, deps=(), files=(), params=None, **kwargs):
+        # Input: stage name + fn(*args, **kwargs) + upstream stage names + input files
+            # params = extra settings the stage output depends on (hashed, not passed to fn)
+        # Output: fn output, from disk when the stage key is unchanged
+        key = self.stage_key(name, args, deps, files, params, kwargs, fn=fn)
+        if self.results is not None:
+            value = self.results.get(key)
+            if value is not None:
+                print('Stage {}: cached'.format(name))
+                self.timings[name] = 0.
+                return value
+        start = time.time()
+        value = fn(*args, **kwargs)
+        self.timings[name] = time.time() - start
+        print('Stage {}: {:.1f}s'.format(name, self.timings[name]))
+        if self.results is not None:
+            self.results.put(key, value)
+        return value
+
+_task_shared = None
+
+def _init_task_worker(shared):
+    # Pool initializer: keep the shared read-only object (inherited, not copied, under fork)
+    global _task_shared
+    _task_shared = shared
+
+def task_shared():
+    # shared object handed to TaskGraph.run, from inside a task
+    return _task_shared
+
+def _run_task(fn, args, kwargs, inputs):
+    start = time.time()
+    value = fn(*inputs, *args, **kwargs)
+    return value, time.time() - start
+
+class TaskGraph:
+    """
+    small DAG executor: each task names the tasks whose outputs it takes as leading
+    arguments and runs in a process pool as soon as they are done, so independent
+    branches overlap; one shared read-only object (e.g. raw adata) is handed to the
+    workers at startup (task_shared()); an optional StageCache skips unchanged tasks
+    """
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, fn, *args, deps=(), params=None, **kwargs):
+        # fn(*[outputs of deps], *args, **kwargs); params = extra cache-key settings
+        for d in deps:
+            if d not in self.tasks:
+                raise ValueError('task {} depends on unknown task {}'.format(name, d))
+        self.tasks[name] = (fn, args, kwargs, tuple(deps), params)
+
+    def run(self, ncores=None, shared=None, stages=None, shared_deps=()):
+        # Input: worker count + shared object + StageCache (shared_deps = its stages that produced shared)
+        # Output: dict of task name -> output; prints critical-path timing summary
+        global _task_shared
+        _task_shared = shared
+        results, timings = {}, {}
+        pending = dict(self.tasks)
+        running = {}
+        done = queue.Queue()
+        start = time.time()
+        p = multiprocessing.Pool(processes=ncores,
+                                 initializer=_init_task_worker,
+                                 initargs=(shared,))
+        try:
+            while pending or running:
+                progress = False
+                for name in list(pending):
+                    fn, args, kwargs, deps, params = pending[name]
+                    if not all(d in results for d in deps):
+                        continue
+                    del pending[name]
+                    progress = True
+                    key = None
+                    if stages is not None:
+                        key = stages.stage_key(name, args, tuple(shared_deps) + deps, params=params,
+                                               kwargs=kwargs, fn=fn)
+                        hit = stages.results.get(key) if stages.results is not None else None
+                        if hit is not None:
+                            print('Task {}: cached'.format(name))
+                            results[name], timings[name] = hit, 0.
+                            continue
+                    running[name] = key
+                    p.apply_async(_run_task, (fn, args, kwargs, [results[d] for d in deps]),
+                                  callback=lambda r, n=name: done.put((n, r, None)),
+                                  error_callback=lambda e, n=name: done.put((n, None, e)))
+                if progress:
+                    continue
+                if not running:
+                    raise ValueError('unresolved task dependencies: {}'.format(list(pending)))
+                name, r, err = done.get()
+                key = running.pop(name)
+                if err is not None:
+                    raise err
+                results[name], timings[name] = r
+                print('Task {}: {:.1f}s'.format(name, timings[name]))
+                if key is not None and stages.results is not None:
+                    stages.results.put(key, results[name])
+        finally:
+            p.terminate()
+            p.join()
+
+        self.summary(timings, time.time() - start)
+        return results
+
+    def critical_path(self, timings):
+        # longest chain of task durations through the graph
+        finish, prev = {}, {}
+        for name in self.tasks:  # tasks are added after their deps
+            deps = self.tasks[name][3]
+            up = max(deps, key=lambda d: finish[d]) if deps else None
+            finish[name] = timings.get(name, 0.) + (finish[up] if up else 0.)
+            prev[name] = up
+        path = [max(finish, key=finish.get)]
+        length = finish[path[0]]
+        while prev[path[-1]] is not None:
+            path.append(prev[path[-1]])
+        return path[::-1], length
+
+    def summary(self, timings, wall):
+        path, length = self.critical_path(timings)
+        print('Task timings (wall {:.1f}s, serial {:.1f}s, critical path {:.1f}s):'.format(wall,
+                                                                                          sum(timings.values()),
+                                                                                          length))
+        for name in self.tasks:
+            print('\t{:<20}{:>8.1f}s {}'.format(name, timings.get(name, 0.), '*' if name in path else ''))
+        print('\tcritical path: {}'.format(' -> '.join(path)))
+
+def _neighbor_graph (adata):
+    # connectivities from sc.pp.neighbors (obsp in newer anndata, uns['neighbors'] in older)
+    if hasattr(adata, 'obsp') and 'connectivities' in adata.obsp:
+        return adata.obsp['connectivities']
+    return adata.uns['neighbors']['connectivities']
+
+def _get_neighbors (adata):
+    result = {'uns': dict(adata.uns['neighbors'])}
+    if hasattr(adata, 'obsp'):
+        result['obsp'] = {k: adata.obsp[k] for k in ('distances', 'connectivities') if k in adata.obsp}
+    return result
+
+def _set_neighbors (adata, result):
+    adata.uns['neighbors'] = result['uns']
+    for k, v in result.get('obsp', {}).items():
+        adata.obsp[k] = v
+
+def _merge_knn (idx, dist, cand_idx, cand_dist, k):
+    # keep the k nearest distinct candidates per row (-1 / inf mark empty slots)
+    idx = np.hstack([idx, cand_idx])
+    dist = np.hstack([dist, cand_dist])
+    order = np.argsort(idx, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    dist = np.take_along_axis(dist, order, axis=1)
+    dup = np.zeros(idx.shape, dtype=bool)
+    dup[:, 1:] = idx[:, 1:] == idx[:, :-1]
+    dist[dup | (idx < 0)] = np.inf
+    keep = np.argpartition(dist, k-1, axis=1)[:, :k]
+    idx = np.take_along_axis(idx, keep, axis=1)
+    dist = np.take_along_axis(dist, keep, axis=1)
+    order = np.argsort(dist, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    dist = np.take_along_axis(dist, order, axis=1)
+    idx[np.isinf(dist)] = -1
+    return idx, dist
+
+def _rp_tree_leaves (X, leaf_size, rng):
+    # random projection tree w/ median splits; output: leaves padded into (n_leaves, leaf_size), -1 fill
+    leaves = []
+    stack = [np.arange(X.shape[0])]
+    while stack:
+        node = stack.pop()
+        if len(node) <= leaf_size:
+            leaves.append(node)
+            continue
+        a, b = rng.choice(len(node), 2, replace=False)
+        normal = X[node[a]] - X[node[b]]
+        if not normal.any():
+            normal = rng.normal(size=X.shape[1])
+        half = len(node) // 2
+        order = np.argpartition(X[node] @ normal, half)
+        stack.append(node[order[:half]])
+        stack.append(node[order[half:]])
+    padded = np.full((len(leaves), leaf_size), -1, dtype=np.int64)
+    for i, leaf in enumerate(leaves):
+        padded[i, :len(leaf)] = leaf
+    return padded
+
+def _leaf_knn (X, sqnorm, leaves, k, chunk_bytes=2e8):
+    # brute force kNN inside each leaf, batched over leaves; output: (n, k) candidate idx / sq dist
+    n_leaves, leaf_size = leaves.shape
+    kk = min(k, leaf_size)
+    cand_idx = np.full((X.shape[0], kk), -1, dtype=np.int64)
+    cand_dist = np.full((X.shape[0], kk), np.inf)
+    step = max(1, int(chunk_bytes // (leaf_size * leaf_size * 8 + leaf_size * X.shape[1] * 8)))
+    for start in range(0, n_leaves, step):
+        L = leaves[start:start+step]
+        valid = L >= 0
+        Li = np.where(valid, L, 0)
+        P = X[Li]
+        D = sqnorm[Li][:, :, None] + sqnorm[Li][:, None, :] - 2 * np.matmul(P, P.transpose(0, 2, 1))
+        D[~(valid[:, :, None] & valid[:, None, :])] = np.inf
+        part = np.argpartition(D, kk-1, axis=2)[:, :, :kk]
+        cd = np.take_along_axis(D, part, axis=2)
+        ci = np.take_along_axis(np.broadcast_to(L[:, None, :], D.shape), part, axis=2)
+        ci[np.isinf(cd)] = -1
+        cand_idx[L[valid]] = ci[valid]
+        cand_dist[L[valid]] = cd[valid]
+    return cand_idx, cand_dist
+
+def approx_knn (X, n_neighbors=30, metric='euclidean', n_trees=8, n_iters=3, n_sample=10,
+                leaf_size=None, random_state=0, delta=0.001):
+    # approximate kNN: random projection forest init + NN-descent refinement (CPU, numpy only)
+    # Input: dense cell x dim matrix (e.g. X_pca) + recall knobs
+        # n_trees = RP trees in the init forest, n_iters = max NN-descent rounds (both raise recall + time)
+    # Output: knn idx + distances (n x n_neighbors, sorted, self first)
+    X = np.asarray(X, dtype=np.float32)
+    if metric == 'cosine':
+        X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    elif metric != 'euclidean':
+        raise ValueError('approx_knn supports euclidean and cosine, got {}'.format(metric))
+    n, k = X.shape[0], min(n_neighbors, X.shape[0])
+    leaf_size = leaf_size or max(2 * k, 64)
+    rng = np.random.RandomState(random_state)
+    sqnorm = np.einsum('ij,ij->i', X, X)
+
+    idx = np.full((n, k), -1, dtype=np.int64)
+    dist = np.full((n, k), np.inf)
+    for _ in range(n_trees):
+        cand_idx, cand_dist = _leaf_knn(X, sqnorm, _rp_tree_leaves(X, leaf_size, rng), k)
+        idx, dist = _merge_knn(idx, dist, cand_idx, cand_dist, k)
+
+    # NN-descent: a neighbor of a neighbor is likely a neighbor; only rows whose own or whose
+    # neighbors' lists changed last round can gain new candidates
+    s = min(n_sample, k)
+    step = max(1, int(2e7 // (s * k * X.shape[1])))
+    changed = np.ones(n, dtype=bool)
+    for _ in range(n_iters):
+        active = np.flatnonzero(changed | changed[np.where(idx >= 0, idx, 0)].any(axis=1))
+        changed = np.zeros(n, dtype=bool)
+        for start in range(0, len(active), step):
+            rows = active[start:start+step]
+            cand = idx[idx[rows, :s]].reshape(len(rows), -1)
+            valid = cand >= 0
+            cand = np.where(valid, cand, 0)
+            cand_dist = (sqnorm[rows][:, None] + sqnorm[cand]
+                         - 2 * np.einsum('cd,cjd->cj', X[rows], X[cand]))
+            cand_dist[~valid] = np.inf
+            new_idx, new_dist = _merge_knn(idx[rows], dist[rows], cand, cand_dist, k)
+            changed[rows] = (new_idx != idx[rows]).any(axis=1)
+            idx[rows], dist[rows] = new_idx, new_dist
+        if changed.sum() <= delta * n:
+            break
+
+    dist = np.sqrt(np.clip(dist, 0, None))
+    if metric == 'cosine':
+        dist = dist**2 / 2
+    # self first (duplicate cells can tie at distance 0)
+    self_pos = (idx == np.arange(n)[:, None]).argmax(axis=1)
+    has_self = idx[np.arange(n), self_pos] == np.arange(n)
+    swap = np.flatnonzero(has_self & (self_pos > 0))
+    idx[swap, self_pos[swap]], dist[swap, self_pos[swap]] = idx[swap, 0], dist[swap, 0]
+    missing = np.flatnonzero(~has_self)
+    idx[missing, 1:], dist[missing, 1:] = idx[missing, :-1], dist[missing, :-1]
+    idx[:, 0], dist[:, 0] = np.arange(n), 0
+    return idx, dist
+
+def umap_connectivities (knn_idx, knn_dist, n_iter=64, bandwidth=1.0):
+    # fuzzy simplicial set weights (umap smooth_knn_dist + symmetric fuzzy union), as sc.pp.neighbors
+    # Input: knn idx/distances w/ self in column 0
+    # Output: sparse distances (self excluded), sparse symmetric connectivities
+    n, k = knn_idx.shape
+    d = knn_dist[:, 1:]
+    nonzero = d > 0
+    rho = np.where(nonzero.any(axis=1), np.where(nonzero, d, np.inf).min(axis=1), 0)
+    target = np.log2(k) * bandwidth
+
+    # binary search for sigma per cell, all cells at once
+    lo, hi, mid = np.zeros(n), np.full(n, np.inf), np.ones(n)
+    for _ in range(n_iter):
+        psum = np.exp(-np.maximum(d - rho[:, None], 0) / mid[:, None]).sum(axis=1)
+        over = psum > target
+        hi = np.where(over, mid, hi)
+        lo = np.where(over, lo, mid)
+        mid = np.where(np.isinf(hi), mid * 2, (lo + hi) / 2)
+    min_scale = np.where(rho > 0, knn_dist.mean(axis=1), knn_dist.mean()) * 1e-3
+    sigma = np.maximum(mid, min_scale)
+
+    w = np.exp(-np.maximum(d - rho[:, None], 0) / sigma[:, None])
+    rows = np.repeat(np.arange(n), k - 1)
+    P = sparse.csr_matrix((w.ravel(), (rows, knn_idx[:, 1:].ravel())), shape=(n, n))
+    connectivities = (P + P.T - P.multiply(P.T)).tocsr()
+    distances = sparse.csr_matrix((d.ravel(), (rows, knn_idx[:, 1:].ravel())), shape=(n, n))
+    return distances, connectivities
+
+def approx_neighbors (adata, n_neighbors=30, n_pcs=None, metric='euclidean', n_trees=8, n_iters=3, random_state=0):
+    # sc.pp.neighbors replacement on X_pca using approx_knn; same graph fields + params
+    start = time.time()
+    X = adata.obsm['X_pca'][:, :n_pcs] if n_pcs else adata.obsm['X_pca']
+    knn_idx, knn_dist = approx_knn(X, n_neighbors=n_neighbors, metric=metric,
+                                   n_trees=n_trees, n_iters=n_iters, random_state=random_state)
+    distances, connectivities = umap_connectivities(knn_idx, knn_dist)
+    params = {'n_neighbors': n_neighbors, 'method': 'umap', 'metric': metric,
+              'approx': {'n_trees': n_trees, 'n_iters': n_iters}}
+    if n_pcs:
+        params['n_pcs'] = n_pcs
+    if hasattr(adata, 'obsp'):
+        adata.obsp['distances'] = distances
+        adata.obsp['connectivities'] = connectivities
+        adata.uns['neighbors'] = {'params': params,
+                                  'distances_key': 'distances',
+                                  'connectivities_key': 'connectivities'}
+    else:
+        adata.uns['neighbors'] = {'params': params,
+                                  'distances': distances,
+                                  'connectivities': connectivities}
+    print('\tApprox. neighbors ({} trees, {} iters): {:.1f}s'.format(n_trees, n_iters, time.time() - start))
+
+def draw_variance_ratio (variance_ratio, title='PCA variance ratio'):
+    # log-scale explained variance per PC (sc.pl.pca_variance_ratio equivalent), pyplot-free
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(4, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(np.arange(1, len(variance_ratio)+1), variance_ratio, 'o', ms=3)
+    ax.set_yscale('log')
+    ax.set_xlabel('PC')
+    ax.set_ylabel('variance ratio')
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
+
+def draw_embedding (coords, labels, title='UMAP'):
+    # 2d embedding colored by cluster w/ labels on data (sc.pl.umap legend_loc='on data'), pyplot-free
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib import cm
+    labels = pd.Categorical(labels)
+    fig = Figure(figsize=(5, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.scatter(coords[:, 0], coords[:, 1], c=cm.tab20(labels.codes % 20), s=2, linewidths=0)
+    for code, cat in enumerate(labels.categories):
+        center = np.median(coords[labels.codes == code], axis=0)
+        ax.text(center[0], center[1], str(cat), ha='center', va='center', weight='bold')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
+
+class PlotRenderer:
+    """
+    background plot writer for headless runs: compute hands over plot data (arrays, data
+    frames, ggplot objects) and moves on; one render thread writes numbered image files to out_dir
+    through Agg canvases. Figures from the draw_* helpers never touch pyplot; plotnine builds
+    ggplot figures through pyplot (not thread-safe), so keep pyplot out of the main thread while
+    ggplots are queued
+    """
+    def __init__(self, out_dir, fmt='png', dpi=100):
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.dpi = dpi
+        self.count = 0
+        self.futures = []
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(out_dir, exist_ok=True)
+
+    def submit(self, name, draw_fn, *args, **kwargs):
+        # draw_fn(*args, **kwargs) -> matplotlib Figure or plotnine ggplot; output: path it will be written to
+        self.count += 1
+        path = os.path.join(self.out_dir, '{:03d}_{}.{}'.format(self.count, name, self.fmt))
+        self.futures.append(self.pool.submit(self._render, path, draw_fn, args, kwargs))
+        return path
+
+    def _render(self, path, draw_fn, args, kwargs):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        plot = draw_fn(*args, **kwargs)
+        if hasattr(plot, 'savefig'):
+            plot.savefig(path, dpi=self.dpi)
+            return path
+
+        # ggplot: saved through an Agg canvas, not plot.save (pyplot's active backend),
+        # then released from pyplot's figure registry
+        import matplotlib.pyplot as plt
+        fig = plot.draw()
+        try:
+            FigureCanvasAgg(fig)
+            fig.savefig(path, dpi=self.dpi)
+        finally:
+            plt.close(fig)
+        return path
+
+    def wait(self):
+        # block until queued plots are written; raises the first render error
+        paths = [f.result() for f in self.futures]
+        self.futures = []
+        return paths
+
+    def close(self):
+        paths = self.wait()
+        self.pool.shutdown()
+        return paths
+
+def pca_adata (adata, num_pcs=None, hoods=30, metric='euclidean', cache=None,
+               knn='exact', knn_trees=8, knn_iters=3, headless=False, renderer=None, **select_kw):
     # Perform PCA dimensionality reduction + plot variance explained
     # Input: adata obj
-    # Output: updated adata obj + print plot
+        # num_pcs = int, 'elbow'/'jackstraw' for automatic selection (select_n_pcs), None to prompt
+        # cache = ResultCache or cache dir; PCA + neighbors restored when X / parameters are unchanged
+        # knn = 'exact' (sc.pp.neighbors) or 'approx' (approx_neighbors; knn_trees/knn_iters trade recall for time)
+        # headless = no prompt (num_pcs None -> elbow) and no inline plot; renderer = PlotRenderer for image files
+    # Output: updated adata obj + print plot; headless: dict of X_pca, variance_ratio, pc_selection
     
     print('Principle component analysis...')
+    cache = as_result_cache(cache)
     
     # Perform PCA
-    sc.tl.pca(adata)
-    adata.obsm['X_pca'] *= -1  # multiply by -1 to match Seurat
-    sc.pl.pca_variance_ratio(adata, log=True)
+    implicit = adata.uns.get('implicit_scale', False)
+    pca_key = cache.key('pca', array_fingerprint(adata.X), implicit=implicit) if cache else None
+    hit = cache.get(pca_key) if cache else None
+    if hit is not None:
+        print('\tPCA: cache hit')
+        adata.obsm['X_pca'], adata.varm['PCs'], adata.uns['pca'] = hit
+    else:
+        if implicit:
+            pca_implicit(adata)
+        else:
+            sc.tl.pca(adata)
+        adata.obsm['X_pca'] *= -1  # multiply by -1 to match Seurat
+        if cache:
+            cache.put(pca_key, (adata.obsm['X_pca'], adata.varm['PCs'], adata.uns['pca']))
+    if renderer is not None:
+        renderer.submit('pca_variance_ratio', draw_variance_ratio, np.array(adata.uns['pca']['variance_ratio']))
+    if not headless:
+        sc.pl.pca_variance_ratio(adata, log=True)
     
     # Neigbhor graph
-    if num_pcs is None:
+    if headless and num_pcs is None:
+        num_pcs = 'elbow'
+    if isinstance(num_pcs, str):
+        num_pcs = select_n_pcs(adata, method=num_pcs, **select_kw)
+    elif num_pcs is None:
         print('Enter number of principle components to use:')
         input1=input()
         try:
@@ -277,24 +1419,55 @@ def pca_adata (adata, num_pcs=None, hoods=30):
             print(e)
             print('Using default settings')
             num_pcs=15
-    
+        adata.uns['pc_selection'] = {'method': 'prompt', 'n_pcs': num_pcs}
+    else:
+        adata.uns['pc_selection'] = {'method': 'manual', 'n_pcs': num_pcs}
+
     print('principle_components(num_pcs): {}\ncells/neighborhood(hoods): {}'.format(num_pcs, hoods))
-    sc.pp.neighbors(adata,n_pcs=num_pcs, n_neighbors=hoods)
+    knn_params = {'knn': knn} if knn == 'exact' else {'knn': knn, 'trees': knn_trees, 'iters': knn_iters}
+    nn_key = cache.key('neighbors', array_fingerprint(adata.obsm['X_pca'][:, :num_pcs]),
+                       n_neighbors=hoods, metric=metric, **knn_params) if cache else None
+    hit = cache.get(nn_key) if cache else None
+    if hit is not None:
+        print('\tNeighbors: cache hit')
+        _set_neighbors(adata, hit)
+    elif knn == 'approx':
+        approx_neighbors(adata, n_neighbors=hoods, n_pcs=num_pcs, metric=metric,
+                         n_trees=knn_trees, n_iters=knn_iters)
+        if cache:
+            cache.put(nn_key, _get_neighbors(adata))
+    else:
+        sc.pp.neighbors(adata,n_pcs=num_pcs, n_neighbors=hoods, metric=metric)
+        if cache:
+            cache.put(nn_key, _get_neighbors(adata))
 
-def umap_adata (adata, res=None, scan=False):
+    if headless:
+        return {'X_pca': adata.obsm['X_pca'],
+                'variance_ratio': adata.uns['pca']['variance_ratio'],
+                'pc_selection': adata.uns['pc_selection']}
+
+def umap_adata (adata, res=None, scan=False, cache=None, warm_start=False, headless=False, renderer=None):
     # Perform clustering and UMAP
     # Input: adata obj + cluster options (below)
         # res = resolution of community detection
-    # Output: updated adata + UMAP to std out
+        # cache = ResultCache or cache dir; UMAP + clusters restored when the neighbor graph is unchanged
+        # warm_start = warm-started resolution scan (see scan_res)
+        # headless = no prompt (res None -> 0.5) and no inline plots; renderer = PlotRenderer for image files
+    # Output: updated adata + UMAP to std out; headless: dict of X_umap, louvain labels, scan results
     
     print('Uniform manifold approximation and projection...')
+    cache = as_result_cache(cache)
     
     # sample resolutions for louvain clustering
+    scan_result = None
     if scan == True:
         print('\tScan Louvain detection resolutions')
-        scan_res(adata) 
+        scan_result = scan_res(adata, warm_start=warm_start, cache=cache, headless=headless, renderer=renderer) 
     
-    if res is None:
+    if res is None and headless:
+        print('Using default settings')
+        res=0.5
+    elif res is None:
         print('Enter Louvain detection resolution to use:')
         input1=input()
         try:
@@ -307,98 +1480,220 @@ def umap_adata (adata, res=None, scan=False):
     print('resolution(res): {}'.format(res))
     
     # UAMP: Uniform Maniford Approximation and Projection
-    sc.tl.umap(adata)
+    umap_key = cache.key('umap', array_fingerprint(_neighbor_graph(adata))) if cache else None
+    hit = cache.get(umap_key) if cache else None
+    if hit is not None:
+        print('\tUMAP: cache hit')
+        adata.obsm['X_umap'] = hit
+    else:
+        sc.tl.umap(adata)
+        if cache:
+            cache.put(umap_key, adata.obsm['X_umap'])
 
     # Louvain community clustering
-    sc.tl.louvain(adata, resolution = res)
-    sc.pl.umap(adata, color=['louvain'], legend_loc='on data')
+    cluster_louvain(adata, res, cache=cache)
+    if renderer is not None:
+        renderer.submit('umap', draw_embedding, np.array(adata.obsm['X_umap']),
+                        np.array(adata.obs['louvain']), title='louvain (res {})'.format(res))
+    if not headless:
+        sc.pl.umap(adata, color=['louvain'], legend_loc='on data')
+    else:
+        return {'X_umap': adata.obsm['X_umap'],
+                'louvain': adata.obs['louvain'].copy(),
+                'scan': scan_result}
     
-def subset_adata (adata, feature_dict):
+class SubsetIndex:
+    """
+    per-column inverted indexes (category -> sorted row positions) over an obs table,
+    built on first use of a column so repeated subsetting only touches matching rows;
+    a column replaced by assignment (obs[key] = ...) is reindexed on next use, edits in place
+    (obs.loc[rows, key] = ...) are not detected: call refresh(key) after them
+    """
+    def __init__(self, obs):
+        self.obs = obs
+        self._index = {}
+
+    def refresh(self, key=None):
+        if key is None:
+            self._index = {}
+        else:
+            self._index.pop(key, None)
+
+    @staticmethod
+    def _column_buffer(col):
+        # the array backing the column (codes for categoricals), no copy
+        return np.asarray(col.values.codes if is_categorical_dtype(col) else col.to_numpy())
+
+    def _column_index(self, key):
+        buffer = self._column_buffer(self.obs[key])
+        # staleness check: same backing buffer as when indexed (O(1); the stored view keeps
+        # the old buffer alive, so its address cannot be reused by a replacement column)
+        if key in self._index:
+            indexed = self._index[key][0]
+            if (indexed.__array_interface__['data'][0] != buffer.__array_interface__['data'][0] or
+                    indexed.shape != buffer.shape):
+                del self._index[key]
+        if key not in self._index:
+            col = self.obs[key]
+            cat = col.values if is_categorical_dtype(col) else pd.Categorical(col)
+            codes = np.asarray(cat.codes)
+            order = np.argsort(codes, kind='mergesort')
+            # rows of category c are order[bounds[c]:bounds[c+1]] (NaN codes -1 sort first)
+            bounds = np.searchsorted(codes[order], np.arange(len(cat.categories)+1))
+            self._index[key] = (buffer, cat.categories, order, bounds)
+        return self._index[key][1:]
+
+    def rows(self, key, values):
+        # sorted row positions where obs[key] is any of values
+        categories, order, bounds = self._column_index(key)
+        codes = categories.get_indexer(pd.Index(values).dropna())
+        codes = np.unique(codes[codes >= 0])
+        if len(codes) == 0:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate([order[bounds[c]:bounds[c+1]] for c in codes]))
+
+    def query(self, feature_dict):
+        # feature_dict semantics as subset_adata: values OR'ed within key, keys AND'ed
+        result = np.arange(len(self.obs))
+        for key, values in feature_dict.items():
+            result = np.intersect1d(result, self.rows(key, values), assume_unique=True)
+        return result
+
+def subset_rows (obs, feature_dict, index=None):
+    # Row positions matching feature_dict: value1 | value2 ... within key, key1 & key2 ... across keys
+    # Input: obs df + dictionary of feature:[value1, value2...] + optional SubsetIndex over obs
+    # Output: sorted np array of row positions
+    if index is not None:
+        return index.query(feature_dict)
+
+    # one-off: categorical codes isin per key
+    keep = np.ones(len(obs), dtype=bool)
+    for key, value in feature_dict.items():
+        col = obs[key]
+        cat = col.values if is_categorical_dtype(col) else pd.Categorical(col)
+        value_codes = cat.categories.get_indexer(pd.Index(value).dropna())
+        keep &= np.isin(np.asarray(cat.codes), value_codes[value_codes >= 0])
+    return np.flatnonzero(keep)
+
+def _print_subset(feature_dict, rows):
+    print('{} matched = {}'.format(' & '.join('{} in {}'.format(key, list(value))
+                                              for key, value in feature_dict.items()),
+                                   len(rows)))
+
+def subset_adata (adata, feature_dict, index=None):
     # Subset adata obj by user dictionary of features and values list. Filter operation below:
         # level1: value1 | value2 | value3...
         # level2: key1 & key2 & key3...
-    # Input: raw_adata obj + dictionary of feature:[value1, value2...]
+    # Input: raw_adata obj + dictionary of feature:[value1, value2...] + optional SubsetIndex over adata.obs
     # Output: subsetted adata obj
     
-    input_adata = adata
-    stack_len = len(input_adata.obs)
-    subset_arr = np.zeros((len(feature_dict), stack_len))
-    
     print('Subsetting data...')
     
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(input_adata.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        subset_arr[key_count, :] = subset_value
-        key_count += 1
-        
-    subset_list = np.product(subset_arr, axis = 0, dtype='bool')    
-    input_adata = input_adata[subset_list,:]
+    rows = subset_rows(adata.obs, feature_dict, index=index)
+    _print_subset(feature_dict, rows)
+    input_adata = adata[rows,:]
     sum_output (input_adata)
     
     return input_adata
 
-def subset_adata_v2 (raw, subset, feature_dict):
+def subset_adata_v2 (raw, subset, feature_dict, index=None):
     # Subset adata obj by user dictionary of features and values list. Filter operation below:
         # level1: value1 | value2 | value3...
         # level2: key1 & key2 & key3...
     # Input: raw_adata obj + subsetted ad obj + dictionary of feature:[value1, value2...]
+    #        + optional SubsetIndex over subset.obs
     # Output: subsetted adata obj
     
-    input_adata = subset
-    stack_len = len(input_adata.obs)
-    subset_arr = np.zeros((len(feature_dict), stack_len))
-    
     print('Subsetting data...')
     
     # subset the subset
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(input_adata.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        subset_arr[key_count, :] = subset_value
-        key_count += 1
-        
-    subset_list = np.product(subset_arr, axis = 0, dtype='bool')    
-    input_adata = input_adata[subset_list,:]
+    rows = subset_rows(subset.obs, feature_dict, index=index)
+    _print_subset(feature_dict, rows)
+    input_adata = subset[rows,:]
     
     # match cell names with raw
-    matches = [True if x in input_adata.obs_names.tolist() else False for x in raw.obs_names.tolist()]
-    output_adata = raw[matches,:] 
+    output_adata = raw[obs_rows_in(raw, input_adata),:] 
     sum_output (output_adata)
     
     return output_adata
 
-def subset_adata_v3 (raw, feature_dict):
-    stack_len = len(raw)
-    bool_arr = np.zeros((len(feature_dict), stack_len))
-    key_count = 0
-    for key,value in feature_dict.items(): 
-        depth = 0
-        stack_depth = len(value)
-        stack = np.empty((stack_depth, stack_len))
-        for val in value:
-            stack[depth, :] = np.array(raw.obs[key] == val, dtype='bool')
-            print('key = {}, value = {}, matched = {}'.format(key,val,np.sum(stack[depth, :], dtype='int')))
-            depth += 1    
-        subset_value = np.sum(stack, axis = 0, dtype='bool')
-        bool_arr[key_count, :] = subset_value
-        key_count += 1
-    subset_list = np.product(bool_arr, axis = 0, dtype='bool')    
-    output_adata = raw[subset_list,:] 
+def obs_indexer (target, source):
+    # get_indexer-style cell name lookup between two ad objs (hash based, linear time)
+    # Input: target ad obj (unique obs_names) + source ad obj
+    # Output: np int array, position in target of each source cell (-1 if absent)
+    if not target.obs_names.is_unique:
+        raise ValueError('target obs_names are not unique; run obs_names_make_unique()')
+    return target.obs_names.get_indexer(source.obs_names)
+
+def obs_rows_in (target, source):
+    # Sorted positions of target cells whose names are present in source
+    return np.flatnonzero(target.obs_names.isin(source.obs_names))
+
+class LazySubset:
+    """
+    deferred subset of an ad obj: only obs/var index arrays are recorded,
+    X is copied once by the next compute stage (process_adata fuses it with normalization)
+    """
+    def __init__(self, adata, obs_idx=None, var_idx=None):
+        # chained lazy subsets collapse onto the original object
+        if isinstance(adata, LazySubset):
+            base_obs = adata.obs_idx
+            base_var = adata.var_idx
+            obs_idx = base_obs if obs_idx is None else base_obs[np.asarray(obs_idx)]
+            var_idx = base_var if var_idx is None else base_var[np.asarray(var_idx)]
+            adata = adata.adata
+        self.adata = adata
+        self.obs_idx = np.arange(adata.n_obs) if obs_idx is None else np.asarray(obs_idx)
+        self.var_idx = np.arange(adata.n_vars) if var_idx is None else np.asarray(var_idx)
+
+    @property
+    def obs(self):
+        return self.adata.obs.iloc[self.obs_idx]
+
+    @property
+    def var(self):
+        return self.adata.var.iloc[self.var_idx]
+
+    @property
+    def obs_names(self):
+        return self.adata.obs_names[self.obs_idx]
+
+    @property
+    def var_names(self):
+        return self.adata.var_names[self.var_idx]
+
+    @property
+    def n_obs(self):
+        return len(self.obs_idx)
+
+    @property
+    def n_vars(self):
+        return len(self.var_idx)
+
+    @property
+    def shape(self):
+        return (self.n_obs, self.n_vars)
+
+    def __len__(self):
+        return self.n_obs
+
+    def __repr__(self):
+        return 'LazySubset of {} cells x {} genes'.format(self.n_obs, self.n_vars)
+
+    def materialize(self):
+        # the single copy of the selected rows/columns
+        if self.n_vars == self.adata.n_vars and np.array_equal(self.var_idx, np.arange(self.adata.n_vars)):
+            return self.adata[self.obs_idx, :].copy()
+        return self.adata[self.obs_idx, self.var_idx].copy()
+
+def subset_adata_v3 (raw, feature_dict, index=None, lazy=False):
+    # lazy=True returns a LazySubset (index arrays only) for the next compute stage to materialize
+    rows = subset_rows(raw.obs, feature_dict, index=index)
+    _print_subset(feature_dict, rows)
+    if lazy == True:
+        output_adata = LazySubset(raw, obs_idx=rows)
+    else:
+        output_adata = raw[rows,:] 
     sum_output (output_adata)
     
     return output_adata    
@@ -454,102 +1749,345 @@ def class2class_reg (X, y, test_size=0.33):
     
     return acc
 
-def scan_res(input_adata, step_size=0.05):
+_louvain_ref = None
+
+def louvain_igraph(data, indices, indptr, directed=True):
+    # weighted igraph from CSR adjacency components, as sc.tl.louvain builds it
+    import igraph as ig
+    sources = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    g = ig.Graph(directed=directed)
+    g.add_vertices(len(indptr)-1)
+    g.add_edges(list(zip(sources, indices)))
+    g.es['weight'] = np.asarray(data, dtype=np.float64)
+    return g
+
+def _louvain_seed_kwargs(louvain, random_state):
+    # louvain < 0.7 seeds a module-level rng; later versions take find_partition(seed=) (as sc.tl.louvain)
+    version = tuple(int(x) for x in louvain.__version__.split('.')[:2])
+    if version < (0, 7):
+        louvain.set_rng_seed(random_state)
+        return {}
+    return {'seed': random_state}
+
+def louvain_partition(g, res, initial_membership=None, random_state=0):
+    # RBConfiguration Louvain at one resolution (sc.tl.louvain vtraag flavor)
+        # initial_membership = labels to start from (warm start) instead of singletons
+    # Output: membership array, communities numbered by size
+    import louvain
+    weights = np.array(g.es['weight'])
+    if initial_membership is not None:
+        initial_membership = [int(x) for x in initial_membership]
+    part = louvain.find_partition(g, louvain.RBConfigurationVertexPartition,
+                                  initial_membership=initial_membership, weights=weights,
+                                  resolution_parameter=res, **_louvain_seed_kwargs(louvain, random_state))
+    return np.array(part.membership)
+
+def louvain_quality(g, membership, res):
+    # RBConfiguration quality of a fixed membership at one resolution (no optimisation)
+    import louvain
+    part = louvain.RBConfigurationVertexPartition(g, initial_membership=[int(x) for x in membership],
+                                                  weights=np.array(g.es['weight']),
+                                                  resolution_parameter=res)
+    return part.quality()
+
+def _init_louvain_worker(graph_dir, directed=True):
+    # Pool initializer: open the memory-mapped neighbor graph (read-only, shared pages) and
+    # build the weighted igraph once per worker
+    global _louvain_ref
+    indptr = np.load('{}/indptr.npy'.format(graph_dir), mmap_mode='r')
+    indices = np.load('{}/indices.npy'.format(graph_dir), mmap_mode='r')
+    data = np.load('{}/data.npy'.format(graph_dir), mmap_mode='r')
+    _louvain_ref = louvain_igraph(data, indices, indptr, directed=directed)
+
+def _louvain_worker(res, random_state=0):
+    # Pool worker: Louvain at one resolution on the shared graph
+    return louvain_partition(_louvain_ref, res, random_state=random_state)
+
+def louvain_categorical(membership):
+    # membership -> categorical labels w/ numerically sorted string categories, as sc.tl.louvain
+    groups = np.asarray(membership)
+    return pd.Categorical(values=groups.astype('U'),
+                          categories=[str(x) for x in np.unique(groups)])
+
+def _louvain_graph(adata):
+    G = sparse.csr_matrix(_neighbor_graph(adata), copy=True)
+    G.eliminate_zeros()
+    return G
+
+def _sweep_cached(cache, fingerprint, res_list):
+    # resolution -> membership for every resolution already in the sweep cache
+    if cache is None:
+        return {}, {}
+    keys = {res: cache.key('louvain', fingerprint, res=res) for res in res_list}
+    hits = {res: cache.get(key) for res, key in keys.items()}
+    return {res: m for res, m in hits.items() if m is not None}, keys
+
+def louvain_sweep(adata, res_list, ncores=None, cache=None):
+    # Louvain at each resolution in parallel on a memory-mapped copy of the neighbor graph
+    # Input: adata w/ neighbors + resolutions + worker count (default: one per resolution, up to cpu count)
+        # ncores=1 runs in-process (no pool; usable from inside a pool worker)
+        # cache = ResultCache or cache dir; resolutions already clustered on this graph are reused
+    # Output: df of labels (obs_names x res_{res}); adata is not modified
+    G = _louvain_graph(adata)
+    cache = as_result_cache(cache)
+    memberships, keys = _sweep_cached(cache, array_fingerprint(G) if cache else None, res_list)
+    todo = [res for res in res_list if res not in memberships]
+
+    start = time.time()
+    ncores = ncores or max(1, min(len(todo), multiprocessing.cpu_count()))
+    if todo and ncores == 1:
+        g = louvain_igraph(G.data, G.indices, G.indptr)
+        for res in todo:
+            memberships[res] = louvain_partition(g, res)
+            if cache:
+                cache.put(keys[res], memberships[res])
+    elif todo:
+        graph_dir = tempfile.mkdtemp(prefix='louvain_graph_')
+        try:
+            for name in ['data', 'indices', 'indptr']:
+                np.save('{}/{}.npy'.format(graph_dir, name), getattr(G, name))
+            p = multiprocessing.Pool(processes=ncores,
+                                     initializer=_init_louvain_worker,
+                                     initargs=(graph_dir,))
+            try:
+                for res, m in zip(todo, p.map(_louvain_worker, todo, chunksize=1)):
+                    memberships[res] = m
+                    if cache:
+                        cache.put(keys[res], m)
+            finally:
+                p.close()
+                p.join()
+        finally:
+            shutil.rmtree(graph_dir, ignore_errors=True)
+    print('\tLouvain sweep: {} resolutions ({} cached) on {} workers in {:.1f}s'.format(len(res_list),
+                                                                                      len(res_list)-len(todo),
+                                                                                      ncores,
+                                                                                      time.time()-start))
+
+    return pd.DataFrame({'res_{}'.format(res): louvain_categorical(memberships[res]) for res in res_list},
+                        index=adata.obs_names)
+
+def warm_louvain_sweep(adata, res_list, cache=None, check_every=4):
+    # Louvain from the finest resolution down, each seeded with the previous (finer) partition:
+    # coarsening only merges communities, so the optimiser starts a few moves from the cold optimum
+    # (seeding upward does not work, the optimiser rarely splits a seeded community)
+    # Input: adata w/ neighbors + resolutions + cache (ResultCache or dir; warm results are keyed
+        # by their seed partition, cold ones are shared with louvain_sweep)
+        # check_every = also cluster every n-th resolution and the coarsest one cold (the finest always
+        # is); a warm partition of lower quality is replaced by the cold one, which seeds the next step
+    # Output: df of labels (obs_names x res_{res}); adata is not modified
+    G = _louvain_graph(adata)
+    cache = as_result_cache(cache)
+    fingerprint = array_fingerprint(G) if cache else None
+    graph = []
+
+    def igraph():
+        if not graph:
+            graph.append(louvain_igraph(G.data, G.indices, G.indptr))
+        return graph[0]
+
+    def run(res, seed=None):
+        key = None
+        if cache:
+            seed_key = {} if seed is None else {'seed': array_fingerprint(seed)}
+            key = cache.key('louvain', fingerprint, res=res, **seed_key)
+        membership = cache.get(key) if cache else None
+        if membership is None:
+            membership = louvain_partition(igraph(), res, initial_membership=seed)
+            if cache:
+                cache.put(key, membership)
+        return membership
+
+    start = time.time()
+    memberships = {}
+    n_cold, n_fallback = 0, 0
+    prev = None
+    res_desc = sorted(res_list, reverse=True)
+    for step, res in enumerate(res_desc):
+        step_start = time.time()
+        if prev is None:
+            prev = run(res)
+            n_cold += 1
+            mode = 'cold'
+        else:
+            prev = run(res, seed=prev)
+            mode = 'warm'
+            if check_every and (step % check_every == 0 or step == len(res_desc)-1):
+                cold = run(res)
+                n_cold += 1
+                q_warm, q_cold = louvain_quality(igraph(), prev, res), louvain_quality(igraph(), cold, res)
+                if q_warm < q_cold and not np.isclose(q_warm, q_cold):
+                    prev = cold
+                    n_fallback += 1
+                    mode = 'warm < cold, reseeded'
+                else:
+                    mode = 'warm, checked'
+        memberships[res] = prev
+        print('\t\tres {}: {:.2f}s ({})'.format(res, time.time()-step_start, mode))
+    print('\tWarm Louvain sweep: {} resolutions ({} cold, {} fallbacks) in {:.1f}s'.format(len(res_list), n_cold,
+                                                                                           n_fallback,
+                                                                                           time.time()-start))
+
+    return pd.DataFrame({'res_{}'.format(res): louvain_categorical(memberships[res]) for res in res_list},
+                        index=adata.obs_names)
+
+def cluster_louvain(adata, res, cache=None):
+    # sc.tl.louvain w/ sweep cache reuse (a resolution already clustered on this graph is not rerun)
+    # Output: updates adata.obs['louvain'] + adata.uns['louvain']
+    cache = as_result_cache(cache)
+    if cache is None:
+        sc.tl.louvain(adata, resolution = res)
+        return
+
+    G = _louvain_graph(adata)
+    key = cache.key('louvain', array_fingerprint(G), res=res)
+    membership = cache.get(key)
+    if membership is None:
+        membership = louvain_partition(louvain_igraph(G.data, G.indices, G.indptr), res)
+        cache.put(key, membership)
+    adata.obs['louvain'] = louvain_categorical(membership)
+    adata.uns['louvain'] = {'params': {'resolution': res}}
+
+def contingency_table(labels_a, labels_b):
+    # sparse contingency table of two labelings (rows: labels_a groups, cols: labels_b groups), O(n)
+    # Output: csr counts + group names for rows / cols
+    codes_a, groups_a = pd.factorize(np.asarray(labels_a), sort=True)
+    codes_b, groups_b = pd.factorize(np.asarray(labels_b), sort=True)
+    table = sparse.coo_matrix((np.ones(len(codes_a), dtype=np.int64), (codes_a, codes_b)),
+                              shape=(len(groups_a), len(groups_b))).tocsr()
+    table.sum_duplicates()
+    return table, groups_a, groups_b
+
+def partition_stability(labels_a, labels_b):
+    # agreement of two labelings from one contingency table, O(n + k^2)
+    # Output: dict of ari, nmi (arithmetic mean normalization, as sklearn), best-match Jaccard
+        # (per labels_b cluster, max Jaccard to any labels_a cluster; size-weighted mean) + flows df
+        # (group_1 = labels_a group, group_2 = labels_b group, count, ncounts) for split/merge plots
+    table, groups_a, groups_b = contingency_table(labels_a, labels_b)
+    n = table.sum()
+    nij = table.data.astype(np.float64)
+    rows, cols = table.nonzero()
+    a = np.asarray(table.sum(axis=1)).ravel().astype(np.float64)
+    b = np.asarray(table.sum(axis=0)).ravel().astype(np.float64)
+
+    # adjusted Rand index
+    comb2 = lambda x: x * (x - 1) / 2
+    sum_ij, sum_a, sum_b = comb2(nij).sum(), comb2(a).sum(), comb2(b).sum()
+    expected = sum_a * sum_b / comb2(n) if n > 1 else 0
+    max_index = (sum_a + sum_b) / 2
+    ari = 1.0 if max_index == expected else (sum_ij - expected) / (max_index - expected)
+
+    # normalized mutual information
+    mi = np.sum(nij / n * np.log(n * nij / (a[rows] * b[cols])))
+    entropy = lambda x: -np.sum(x / n * np.log(x / n))
+    h_a, h_b = entropy(a), entropy(b)
+    nmi = 1.0 if h_a == h_b == 0 else max(mi, 0) / ((h_a + h_b) / 2)
+
+    # best-match Jaccard per labels_b cluster
+    jaccard = sparse.csr_matrix((nij / (a[rows] + b[cols] - nij), (rows, cols)), shape=table.shape)
+    best = jaccard.max(axis=0).toarray().ravel()
+    best_jaccard = np.sum(best * b) / n
+
+    flows = pd.DataFrame({'group_1': groups_a[rows],
+                          'group_2': groups_b[cols],
+                          'count': nij.astype(np.int64)})
+    flows['ncounts'] = flows['count'] / n
+    return {'ari': ari, 'nmi': nmi, 'jaccard': best_jaccard, 'flows': flows}
+
+def sweep_stability(labels):
+    # stability of consecutive resolutions in a scan_res / louvain_sweep labels table
+    # Output: df of ari, nmi, jaccard per res (rel. to previous res) + flows df of all steps
+    #   (first step flows are its own occupancies, group_1 == group_2)
+    res_vals = labels.columns.tolist()
+    first = labels[res_vals[0]].value_counts(sort=False)
+    flows = [pd.DataFrame({'group_1': first.index.values, 'group_2': first.index.values,
+                           'count': first.values, 'ncounts': first.values / first.sum(),
+                           'step': res_vals[0]})]
+    scores = []
+    for prev, curr in zip(res_vals[:-1], res_vals[1:]):
+        result = partition_stability(labels[prev].values, labels[curr].values)
+        result['flows']['step'] = curr
+        flows.append(result.pop('flows'))
+        result['res'] = curr
+        scores.append(result)
+    return pd.DataFrame(scores, columns=['res', 'ari', 'nmi', 'jaccard']), pd.concat(flows, ignore_index=True)
+
+def scan_res(input_adata, step_size=0.05, ncores=None, warm_start=False, cache=None, headless=False, renderer=None):
     # Scan through resolution setting for Louvain clustering and return similarity to previous step. Used to determine resolution setting.
-    # Input: ad obj + step size (optional; float)
-    # Output: print plot
+    # Input: ad obj + step size (optional; float) + worker processes for the sweep (optional)
+        # warm_start = fine-to-coarse sweep seeded w/ the previous partition (serial; see warm_louvain_sweep)
+        # cache = ResultCache or cache dir; clustered resolutions persist across scans / step sizes
+        # headless = no inline plots; renderer = PlotRenderer for image files
+    # Output: print plot + df of labels per resolution (input_adata is not modified)
+        # headless: dict of labels, stability (ari/nmi/jaccard per res) and flows dfs
     
     print('\tresolution_interval(step_size): {}'.format(step_size))
     
     basis_point = int(step_size * 100)
     
     # compute clusters
-    df = pd.DataFrame()
     res_list = [x/100 for x in range(basis_point,100,basis_point)]
-    for res in res_list:
-        tmp = input_adata
-        sc.tl.louvain(tmp, resolution = res)
-        df['res_{}'.format(res)] = tmp.obs['louvain']
+    if warm_start:
+        labels = warm_louvain_sweep(input_adata, res_list, cache=cache)
+    else:
+        labels = louvain_sweep(input_adata, res_list, ncores=ncores, cache=cache)
     
-    # plot cluster occupancies
-    res_vals = df.columns.tolist()
-    base_df = (df.groupby(df.columns.tolist()[0]).size()
-                    .reset_index()
-                    .rename({0:'count',
-                             df.columns.tolist()[0]:'group_2'}, axis='columns'))
-    base_df['group_1'] = base_df['group_2']
-    base_df['step'] = res_vals[0]
-    base_df['ncounts'] = base_df['count']/base_df['count'].sum()
-    
-    for idx,x in enumerate(range(2,len(df.columns.tolist())+1,1)):
-        columns_oi = df.columns.tolist()[(x-2):x]
-        tmp = (df.groupby(columns_oi)
-                .size()
-                .reset_index()
-                .rename({0:'count', 
-                         columns_oi[0]:'group_1',
-                         columns_oi[1]:'group_2'}, axis='columns'))
-        tmp['step'] = res_vals[idx+1]
-        tmp['ncounts'] = tmp['count']/tmp['count'].sum()
-        base_df = base_df.append(tmp)
+    # split/merge flows + stability from one contingency table per resolution pair
+    stability_df, base_df = sweep_stability(labels)
 
+    # plot cluster occupancies
     groupcat1 = CategoricalDtype(['{}'.format(x) for x in range(len(set(base_df['group_1'])))],ordered=True)
     base_df['group_1_cat'] = base_df['group_1'].astype(str).astype(groupcat1)
     groupcat2 = CategoricalDtype(['{}'.format(x) for x in range(len(set(base_df['group_2'])))],ordered=True)
     base_df['group_2_cat'] = base_df['group_2'].astype(str).astype(groupcat2)
 
-    plotnine.options.figure_size = (8,8)
-    print(ggplot(base_df)
-            +theme_bw()
-            +theme(aspect_ratio=1)
-            +geom_bar(aes('group_2_cat','ncounts',fill='group_1_cat'),stat='identity')
-            +facet_wrap('~step')
-            +labs(x='current label', y='proportion of cells', fill='previous label'))
-    
-    # plot max Jaccard index for each pair of resolutions
-    # convert to int for addition operation
-    for col in df.columns.tolist():
-        df[col] = df[col].astype(int)
-
-    # return max jaccard index value over n+1 label iterator
-    jidx_list = []
-    for idx, col in enumerate(res_vals):
-        if idx > 0:
-            ref = df[res_vals[idx-1]].tolist()
-            curr = df[res_vals[idx]].tolist()
-
-            poss_labs = list(set(ref+curr))
-            jidx_poss = [jaccard_similarity_score(ref, curr)]
-            for idx, x in enumerate(range(len(poss_labs)-1)):
-                reset_val = max(poss_labs)
-                ref = [(x+1) if (x <= reset_val) else 0 for x in ref]
-                jidx_poss.append(jaccard_similarity_score(ref, curr))
-            jidx_list.append(max(jidx_poss))
-    jidx_df = pd.DataFrame({'jidx':jidx_list, 'res':res_vals[1:]})
-    
-    plotnine.options.figure_size = (3,3)
-    print(ggplot(jidx_df)
-             +theme_bw()
-             +theme(aspect_ratio=1,
-                    axis_text_x=element_text(angle=90))
-             +geom_bar(aes('res','jidx'), stat='identity')
-             +labs(y='Jaccard index (rel. to prev. res.)',x='current res.'))
-    
+    occupancy_plot = (ggplot(base_df)
+                        +theme_bw()
+                        +theme(aspect_ratio=1, figure_size=(8,8))
+                        +geom_bar(aes('group_2_cat','ncounts',fill='group_1_cat'),stat='identity')
+                        +facet_wrap('~step')
+                        +labs(x='current label', y='proportion of cells', fill='previous label'))
+    
+    # plot best-match Jaccard index for each pair of resolutions
+    jidx_df = stability_df.rename({'jaccard':'jidx'}, axis='columns')
+    
+    jidx_plot = (ggplot(jidx_df)
+                    +theme_bw()
+                    +theme(aspect_ratio=1,
+                           figure_size=(3,3),
+                           axis_text_x=element_text(angle=90))
+                    +geom_bar(aes('res','jidx'), stat='identity')
+                    +labs(y='Jaccard index (rel. to prev. res.)',x='current res.'))
+
+    if renderer is not None:
+        # ggplot objects are lazy; the render thread draws them
+        renderer.submit('scan_occupancy', lambda plot: plot, occupancy_plot)
+        renderer.submit('scan_jaccard', lambda plot: plot, jidx_plot)
+    if headless:
+        return {'labels': labels, 'stability': stability_df, 'flows': base_df}
+    print(occupancy_plot)
+    print(jidx_plot)
+
+    return labels
+    
+def class_labels(raw_adata, clustered_adata, input_class, type_dict):
+    # Labels classify_type would write, without touching raw ad obj
+    # Output: object array aligned to raw_adata.obs ('unknown' for unmatched cells)
+    type_list = np.array(['unknown'] * len(raw_adata.obs), dtype=object)
+    
+    # position of each clustered cell in raw
+    raw_idx = obs_indexer(raw_adata, clustered_adata)
+    clusters = clustered_adata.obs[input_class]
+    for key,value in type_dict.items():
+        hits = clusters.isin(value).values & (raw_idx >= 0)
+        type_list[raw_idx[hits]] = key
+    return type_list
+
 def classify_type(raw_adata, clustered_adata, input_class, type_dict, output_class):
     # Manually classify
     # Input: raw ad obj (unfiltered) + ad obj with cluster assignments + dict of labels:cluster assignment + colname
     # Output: update raw ad obj in place
-    
-    type_list = ['unknown'] * len(raw_adata.obs)
-    
-    for key,value in type_dict.items():
-        clustered_names = [name for cluster,name in zip(clustered_adata.obs[input_class], 
-                                                             clustered_adata.obs_names) if cluster in value]  
-        value_idx = [idx for idx,x in enumerate(raw_adata.obs_names) if x in clustered_names]
-        for x in value_idx:
-            type_list[x] = key
-            
-    raw_adata.obs[output_class] = type_list
+    raw_adata.obs[output_class] = class_labels(raw_adata, clustered_adata, input_class, type_dict)
     
 def rank_genes (input_adata, methods=['wilcoxon','t-test_overestim_var'],n_genes=20, groupby='louvain'):
     # Rank genes
@@ -575,21 +2113,42 @@ def rank_genes (input_adata, methods=['wilcoxon','t-test_overestim_var'],n_genes
     
     return stack_df
 
-def push_rank (df_rank, title, wkdir, s3dir):
+def push_rank (df_rank, title, wkdir, s3dir, compress=False):
     # save CSV of gene list to output to S3
-    # Input: df of ranks + local/s3 paths + title
-    # Output: push to s3
-    
-    rank_fn = 'GeneRank_{}.csv'.format(title)
-    rank_path = '{}/{}'.format(wkdir, rank_fn)
-    df_rank.to_csv(rank_path)
-    s3_cmd = 'aws s3 cp --quiet {}/{} s3://{}/'.format(wkdir,rank_fn,s3dir)
-    subprocess.run(s3_cmd.split()) # push to s3
-    subprocess.run(['rm', rank_path]) # remove local copy    
-    
+    # Input: df of ranks + local/s3 paths + title (wkdir no longer written to, kept for existing calls)
+    # Output: push to s3 + df of upload results (warns if the upload failed)
+
+    return push_ranks({title:df_rank}, s3dir, compress=compress)
+
+def push_ranks (rank_dfs, s3dir, manager=None, compress=False):
+    # Upload rank tables to S3 concurrently, serialized in memory (no local file, no aws cli)
+    # Input: dict of title:df of ranks + s3 'bucket/prefix' + optional S3TransferManager + gzip flag
+    # Output: df of upload results; prints s3 download links of uploaded tables, warns on failed ones
+
+    if manager is None:
+        manager = default_s3_manager()
+
+    rank_fns = ['GeneRank_{}.csv{}'.format(title, '.gz' if compress == True else '') for title in rank_dfs]
+    bodies = [df_to_buffer(df_rank, compress=compress) for df_rank in rank_dfs.values()]
+    results = manager.upload(['s3://{}/{}'.format(s3dir, rank_fn) for rank_fn in rank_fns],
+                             bodies,
+                             content_type='application/gzip' if compress == True else 'text/csv')
+
     # print s3 download link
-    dl_link = 'https://s3-us-west-2.amazonaws.com/{}/{}'.format(s3dir,rank_fn)
-    print(dl_link)
+    for rank_fn, status in zip(rank_fns, results['status']):
+        if status == 'uploaded':
+            dl_link = 'https://s3-us-west-2.amazonaws.com/{}/{}'.format(s3dir,rank_fn)
+            print(dl_link)
+
+    failed = results[results['status'] == 'failed']
+    if len(failed) > 0:
+        warnings.warn('{} of {} rank tables failed to upload:\n{}'.format(
+            len(failed), len(results),
+            '\n'.join('{}: {}'.format(x, e) for x, e in zip(failed['s3path'], failed['error']))))
+
+    return results
+
+    return results
     
 def PC_contribution (target, input_adata):
     # Determine gene contribution to PC
@@ -723,9 +2282,9 @@ def rank_push (input_adata, groupby, prefix, wkdir, s3dir, methods=['wilcoxon','
                              'inner',
                              ['gene',groupby])
 
-        # push to s3
-        push_rank (rank_df, f'{prefix}_full', wkdir, s3dir)
-        push_rank (joined_test, f'{prefix}_joined', wkdir, s3dir)
+        # push to s3 (both tables concurrently)
+        push_ranks ({f'{prefix}_full':rank_df,
+                     f'{prefix}_joined':joined_test}, s3dir)
     
         return rank_df, joined_test
     
@@ -776,8 +2335,9 @@ def rho2_only(x, y):
     
 def txn_noise_spearman(cell_list, pre_adata):
     pre_slice = pre_adata.loc[:,cell_list]
-    gene_slice = pre_slice[[not x.startswith('ERCC-') for x in pre_slice.index]]
-    ercc_slice = pre_slice[[x.startswith('ERCC-') for x in pre_slice.index]]
+    is_ercc = feature_class_mask(pre_slice.index, prefixes=feature_prefixes['ercc'])
+    gene_slice = pre_slice[~is_ercc]
+    ercc_slice = pre_slice[is_ercc]
     # calculate group means:
     gene_mean = gene_slice.mean(axis = 1).values
     ercc_mean = ercc_slice.mean(axis = 1).values
@@ -796,54 +2356,311 @@ def s3_crawler(plate_list, s3dir_df, manual_filter = False):
     #! aws s3 ls s3://czbiohub-seqbot --recursive | awk '{print "s3://czbiohub-seqbot/"$4}' > DL20190114_czbiohubseqbot.txt
     #! aws s3 ls s3://czb-seqbot --recursive | awk '{print "s3://czb-seqbot/"$4}' > DL20190114_czbseqbot.txt
     #! for i in DL20190114_czbseqbot.txt DL20190114_czbiohubseqbot.txt; do aws s3 cp $i s3://daniel.le-work/MEL_project/; done
+    # or, from a cached listing (scanpy_helpers_2.S3ListingManifest), re-listed in full when stale:
+    #   manifest.refresh('czb-seqbot', full=True); s3dir_df = manifest.query('czb-seqbot', suffix='homo.htseq-count.txt')
 
     # filter to only counts tables that match plate id
+    # one pass over s3dir_df: plate/cell fields parsed once, grouped by plate
+    index_df = index_s3_plates(s3dir_df, plate_list)
+    plate_groups = dict(list(index_df.groupby('plate', sort=False)))
 
-    plate_dfs = pd.DataFrame()
+    plate_dfs = []
     for plate_id in plate_list:
-        
-        # parse path
-        paths = [x for x in s3dir_df.paths if plate_id in x]
-        fname = [x.split('/')[-1] for x in paths]
-        cell = ['_'.join(x.split('_')[:2]) for x in fname]
-        df = pd.DataFrame({'paths':paths,
-                          'fname':fname,
-                          'cell':cell})
-        df = pd.merge(pd.DataFrame({'cell':df['cell'].value_counts().index}),df,'left','cell')
-        df['idx'] = [y for x in df['cell'].value_counts() for y in range(x)]
-        df['plate'] = plate_id
-        redundant_names = [x > 1 for x in df['cell'].value_counts()]
-        
+        df = plate_groups.get(plate_id, index_df.iloc[:0])
+        redundant_names = df.drop_duplicates('cell')['copies'].values > 1
+
         # remove redundant module
         print('{} pre-filter redundant names'.format(sum(redundant_names)))
         while manual_filter is True and any(redundant_names):
-            for path in df.loc[df.cell == df['cell'].value_counts().index[0]].paths:
+            for path in df.loc[df.cell == df.cell.iloc[0]].paths:
                 print(path)
             print('Input parent s3 path that contains all samples to keep')
             parent_path = input()
-            df = df[[x.startswith(parent_path) for x in df.paths]]
-            redundant_names = [x > 1 for x in df['cell'].value_counts()]
-        plate_dfs = plate_dfs.append(df)
+            df = _count_copies(df[df.paths.str.startswith(parent_path).values])
+            redundant_names = df.drop_duplicates('cell')['copies'].values > 1
+        plate_dfs.append(df)
         print('Plate {} has {}/{} redundant names'.format(plate_id,
-                                                          sum([x > 0 for x in df.idx]),
+                                                          sum(df.idx > 0),
                                                           len(df)))
+    plate_dfs = pd.concat(plate_dfs).drop(columns='copies') if len(plate_dfs) > 0 else pd.DataFrame()
     print('Found {} samples in {} plates'.format(len(plate_dfs),
-                                                len(set(plate_dfs.plate))))
+                                                len(set(plate_dfs.plate)) if len(plate_dfs) > 0 else 0))
 
     return plate_dfs
 
+def _count_copies(df):
+    # copies per cell name and copy index within cell, most redundant cells first
+    df = df.copy()
+    df['copies'] = df.groupby('cell')['cell'].transform('size').values
+    df = df.sort_values(['copies', 'cell'], ascending=[False, True], kind='mergesort')
+    df['idx'] = df.groupby('cell').cumcount().values
+    return df
+
+def index_s3_plates(s3dir_df, plate_list=None):
+    # Index listed s3 paths by plate id parsed from the file name (well_plate_...)
+    # Input: df with paths column + optional list of plates to keep
+    # Output: df of paths, fname, cell, plate, idx (copy number within cell), copies
+    paths = s3dir_df['paths'].astype(str).reset_index(drop=True)
+    fname = paths.str.rsplit('/', n=1).str[-1]
+    fields = fname.str.split('_', n=2, expand=True)
+    if fields.shape[1] < 2:
+        return pd.DataFrame(columns=['paths','fname','cell','idx','plate','copies'])
+
+    df = pd.DataFrame({'paths':paths,
+                       'fname':fname,
+                       'cell':fields[0] + '_' + fields[1],
+                       'plate':fields[1]})
+    df = df[df.plate.notnull()]
+    if plate_list is not None:
+        df = df[df.plate.isin(plate_list)]
+    df = _count_copies(df)
+
+    return df.loc[:, ['paths','fname','cell','idx','plate','copies']]
+
 def pulls3(args):
     # Parallizable pull s3 data
-    path, plate, fname, wdkir = args
+    path, plate, fname, wkdir = args
     curr_dir = f'{wkdir}/tmp/{plate}'
         
     if not os.path.exists(f'{curr_dir}/{fname}'):
         if not os.path.exists(curr_dir):
-            os.mkdir(curr_dir)
+            os.makedirs(curr_dir)
     
         cmd = f'aws s3 cp {path} {curr_dir}/'
         subprocess.run(cmd.split(' '))
 
+def split_s3path(s3path):
+    # 's3://bucket/key/parts' -> ('bucket', 'key/parts')
+    bucket, _, key = s3path.replace('s3://', '', 1).partition('/')
+    return bucket, key
+
+def file_md5(path, blocksize=1<<20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class LocalS3Client:
+    """
+    filesystem-backed stand-in for the boto3 s3 client calls used in this module,
+    objects live at {root}/{bucket}/{key}; use for offline runs and tests
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, Bucket, Key):
+        return '{}/{}/{}'.format(self.root, Bucket, Key)
+
+    def _missing(self, Bucket, Key, operation):
+        return ClientError({'Error':{'Code':'NoSuchKey',
+                                     'Message':'s3://{}/{} not found'.format(Bucket, Key)}},
+                           operation)
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self._missing(Bucket, Key, 'HeadObject')
+        return {'ContentLength':os.path.getsize(path),
+                'ETag':'"{}"'.format(file_md5(path))}
+
+    def get_object(self, Bucket, Key):
+        head = self.head_object(Bucket, Key)
+        head['Body'] = open(self._path(Bucket, Key), 'rb')
+        return head
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {'ETag':'"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        bucket_dir = '{}/{}'.format(self.root, Bucket)
+        keys = sorted(os.path.relpath(path, bucket_dir).replace(os.sep, '/')
+                      for path in glob.iglob('{}/**'.format(bucket_dir), recursive=True)
+                      if os.path.isfile(path))
+        after = ContinuationToken if ContinuationToken is not None else StartAfter
+        keys = [x for x in keys if x.startswith(Prefix) and x > after]
+        page = keys[:MaxKeys]
+        contents = []
+        for key in page:
+            path = self._path(Bucket, key)
+            contents.append({'Key':key,
+                             'Size':os.path.getsize(path),
+                             'ETag':'"{}"'.format(file_md5(path)),
+                             'LastModified':os.path.getmtime(path)})
+        response = {'Contents':contents, 'IsTruncated':len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+class S3TransferManager:
+    """
+    in-process S3 transfers: bounded thread pool sharing one boto3 client,
+    retries with exponential backoff, skips local files that already match by size/ETag
+
+    client: boto3 s3 client (default) or stand-in such as LocalS3Client
+    endpoint_url: e.g. local S3 stand-in (moto/minio) when client is None
+    """
+    no_retry_codes = ('404', 'NoSuchKey', 'NoSuchBucket', '403', 'AccessDenied')
+
+    def __init__(self, client=None, max_workers=16, max_retries=4, backoff=0.5, endpoint_url=None):
+        if client is None:
+            client = boto3.client('s3',
+                                  endpoint_url=endpoint_url,
+                                  config=Config(max_pool_connections=max_workers))
+        self.client = client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def _retry(self, fn, **kwargs):
+        # returns (result, attempts); re-raises after max_retries or on non-retryable errors
+        for attempt in range(1, self.max_retries+1):
+            try:
+                return fn(**kwargs), attempt
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in self.no_retry_codes or attempt == self.max_retries:
+                    raise
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+            time.sleep(self.backoff * 2**(attempt-1) * (1 + random.random()))
+
+    def _local_matches(self, local_path, size, etag, check_etag):
+        if not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+            return False
+        # multipart ETags are not an md5 of the content, size check only
+        if check_etag == True and etag is not None and '-' not in etag:
+            return file_md5(local_path) == etag.strip('"')
+        return True
+
+    def _download_one(self, job):
+        s3path, local_path, size, etag, check_etag = job
+        bucket, key = split_s3path(s3path)
+        result = {'s3path':s3path, 'local_path':local_path, 'status':'downloaded',
+                  'bytes':0, 'attempts':0, 'error':None}
+        try:
+            if os.path.isfile(local_path):
+                if size is None:
+                    head, attempts = self._retry(self.client.head_object, Bucket=bucket, Key=key)
+                    result['attempts'] += attempts
+                    size, etag = head['ContentLength'], head.get('ETag')
+                if self._local_matches(local_path, size, etag, check_etag):
+                    result['status'] = 'skipped'
+                    return result
+
+            local_dir = os.path.dirname(local_path)
+            if local_dir and not os.path.exists(local_dir):
+                os.makedirs(local_dir, exist_ok=True)
+
+            def fetch(Bucket, Key):
+                # whole get+write is retried, a dropped stream restarts the object
+                response = self.client.get_object(Bucket=Bucket, Key=Key)
+                tmp_path = '{}.part'.format(local_path)
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        shutil.copyfileobj(response['Body'], f)
+                finally:
+                    response['Body'].close()
+                nbytes = os.path.getsize(tmp_path)
+                if nbytes != response['ContentLength']:
+                    raise IOError('short read on {}: {}/{} bytes'.format(s3path, nbytes,
+                                                                         response['ContentLength']))
+                os.replace(tmp_path, local_path)
+                return nbytes
+
+            nbytes, attempts = self._retry(fetch, Bucket=bucket, Key=key)
+            result['attempts'] += attempts
+            result['bytes'] = nbytes
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+            if os.path.exists('{}.part'.format(local_path)):
+                os.remove('{}.part'.format(local_path))
+        return result
+
+    def download(self, s3paths, local_paths, sizes=None, etags=None, check_etag=False):
+        # Pull s3paths to local_paths concurrently
+        # Input: lists of s3 paths and local paths + optional known sizes/ETags (saves a HEAD per existing file)
+        # Output: df with one row per file (status downloaded/skipped/failed, bytes, attempts, error)
+        n = len(s3paths)
+        sizes = [None]*n if sizes is None else sizes
+        etags = [None]*n if etags is None else etags
+        jobs = list(zip(s3paths, local_paths, sizes, etags, [check_etag]*n))
+
+        return self._run(self._download_one, jobs,
+                         ['s3path','local_path','status','bytes','attempts','error'],
+                         ['downloaded','skipped','failed'])
+
+    def _upload_one(self, job):
+        s3path, body, content_type = job
+        bucket, key = split_s3path(s3path)
+        result = {'s3path':s3path, 'status':'uploaded', 'bytes':len(body), 'attempts':0, 'error':None}
+        kwargs = {'Bucket':bucket, 'Key':key, 'Body':body}
+        if content_type is not None:
+            kwargs['ContentType'] = content_type
+        try:
+            _, result['attempts'] = self._retry(self.client.put_object, **kwargs)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        return result
+
+    def upload(self, s3paths, bodies, content_type=None):
+        # Push in-memory bytes to s3paths concurrently
+        # Input: list of s3 paths + list of bytes bodies + optional ContentType
+        # Output: df with one row per object (status uploaded/failed, bytes, attempts, error)
+        jobs = list(zip(s3paths, bodies, [content_type]*len(s3paths)))
+        return self._run(self._upload_one, jobs,
+                         ['s3path','status','bytes','attempts','error'],
+                         ['uploaded','failed'])
+
+    def _run(self, fn, jobs, columns, statuses):
+        # map fn over jobs in the thread pool and report throughput
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(tqdm.tqdm(pool.map(fn, jobs), total=len(jobs)))
+        elapsed = max(time.time() - start, 1e-9)
+
+        results_df = pd.DataFrame(results, columns=columns)
+        status = results_df['status'].value_counts()
+        print('{} in {:.1f}s ({:.1f} files/sec, {:.2f} MB/s)'.format(
+            ', '.join('{} {}'.format(status.get(x, 0), x) for x in statuses), elapsed,
+            len(jobs)/elapsed, results_df['bytes'].sum()/1e6/elapsed))
+
+        return results_df
+
+_default_s3_manager = None
+
+def default_s3_manager():
+    # shared S3TransferManager (one pooled boto3 client per kernel)
+    global _default_s3_manager
+    if _default_s3_manager is None:
+        _default_s3_manager = S3TransferManager()
+    return _default_s3_manager
+
+def df_to_buffer(df, compress=False):
+    # Serialize df to CSV bytes in memory, gzipped if compress
+    body = df.to_csv().encode()
+    if compress == True:
+        body = gzip.compress(body)
+    return body
+
+def pull_plates_s3(plate_dfs, wkdir, manager=None, max_workers=16):
+    # In-process replacement for pool.map(pulls3, ...) over s3_crawler output
+    # Input: plate_dfs (paths, plate, fname) + local working dir + optional S3TransferManager
+    # Output: df of transfer results; files land in {wkdir}/tmp/{plate}/{fname} as with pulls3
+    if manager is None:
+        manager = S3TransferManager(max_workers=max_workers)
+    local_paths = ['{}/tmp/{}/{}'.format(wkdir, plate, fname)
+                   for plate, fname in zip(plate_dfs.plate, plate_dfs.fname)]
+    return manager.download(plate_dfs.paths.tolist(), local_paths)
+
 def merge_counts(top_dir):
     # Create big counts table from local tables
     file_list = [filename for filename in glob.iglob(top_dir + '**/*.txt', recursive=True)]
@@ -874,9 +2691,339 @@ def merge_counts(top_dir):
     
     # reset gene col
     master_df = master_df.set_index('gene').reset_index()
-    
+
     return master_df
 
+def count_file_names(file_list, existing=None):
+    # Cell names for HTSeq count files, same convention as merge_counts (well_plate_n)
+    # Input: list of file paths + optional names already taken
+    # Output: list of unique cell names
+    colnames = []
+    seen = set() if existing is None else set(existing)
+    for file in file_list:
+        prefix = '_'.join(file.split('/')[-1].split('_')[:2])
+        dup_idx = 0
+        while '{}_{}'.format(prefix, dup_idx) in seen:
+            dup_idx += 1
+        colname = '{}_{}'.format(prefix, dup_idx)
+        seen.add(colname)
+        colnames.append(colname)
+    return colnames
+
+def read_htseq_counts(file):
+    # Parse one HTSeq count file without pandas (tokens are tab/newline separated)
+    # Input: path to tab-delimited gene/count file
+    # Output: (list of gene names as bytes, np int64 array of counts) incl. __ metadata rows
+    with open(file, 'rb') as f:
+        tokens = f.read().split()
+    counts = np.fromstring(b' '.join(tokens[1::2]), dtype=np.int64, sep=' ')
+    return tokens[0::2], counts
+
+_merge_ref = None
+
+def _init_merge_worker(ref_genes, keep_idx):
+    # Pool initializer: hand the reference gene order to each worker once
+    global _merge_ref
+    _merge_ref = (ref_genes, keep_idx)
+
+def _merge_parse_worker(file):
+    # Pool worker: parse a count file, check gene order, drop __ rows, return sparse row
+    ref_genes, keep_idx = _merge_ref
+    genes, counts = read_htseq_counts(file)
+    if genes != ref_genes:
+        raise ValueError('gene order in {} differs from first file'.format(file))
+    counts = counts[keep_idx].astype(np.int32)
+    nonzero = np.flatnonzero(counts).astype(np.int32)
+    return nonzero, counts[nonzero]
+
+def merge_counts_sparse(top_dir, ncores=None, chunksize=64, file_list=None):
+    # Create cell x gene int32 sparse counts matrix from local HTSeq tables in a process pool
+    # Input: top dir (globbed as merge_counts) or explicit file_list + number of processes
+    # Output: (sparse csr cell x gene int32, list of gene names, list of cell names)
+
+    if file_list is None:
+        file_list = [filename for filename in glob.iglob(top_dir + '**/*.txt', recursive=True)]
+    if len(file_list) == 0:
+        raise ValueError('no count files found in {}'.format(top_dir))
+    if ncores is None:
+        ncores = max(multiprocessing.cpu_count() - 1, 1)
+
+    # reference gene order from the first file, __ metadata rows dropped by position
+    ref_genes, _ = read_htseq_counts(file_list[0])
+    keep_idx = np.array([idx for idx,x in enumerate(ref_genes) if not x.startswith(b'__')])
+    gene_names = [ref_genes[idx].decode() for idx in keep_idx]
+
+    start = time.time()
+    indices_list = []
+    data_list = []
+    p = multiprocessing.Pool(processes=ncores,
+                             initializer=_init_merge_worker,
+                             initargs=(ref_genes, keep_idx))
+    try:
+        for nonzero, counts in tqdm.tqdm(p.imap(_merge_parse_worker, file_list, chunksize=chunksize),
+                                         total=len(file_list)):
+            indices_list.append(nonzero)
+            data_list.append(counts)
+    finally:
+        p.close()
+        p.join()
+    elapsed = time.time() - start
+
+    indptr = np.zeros(len(file_list)+1, dtype=np.int64)
+    np.cumsum([len(x) for x in indices_list], out=indptr[1:])
+    X = sparse.csr_matrix((np.concatenate(data_list), np.concatenate(indices_list), indptr),
+                          shape=(len(file_list), len(gene_names)))
+
+    print('Merged {} files in {:.1f}s ({:.0f} files/sec)'.format(len(file_list),
+                                                              elapsed,
+                                                              len(file_list)/max(elapsed, 1e-9)))
+
+    return X, gene_names, count_file_names(file_list)
+
+def _replace_write(path, write_fn):
+    # write to a tmp file then swap in, so readers never see a partial file
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+def save_counts_store(store_dir, X, gene_names, cell_names):
+    # Save cell x gene CSR counts as raw .npy components + name tables for memory-mapped reloads
+    # Input: dir + sparse matrix + gene/cell name lists
+    # Output: store_dir/{data,indices,indptr}.npy + genes.txt + cells.txt
+    X = sparse.csr_matrix(X)
+    if X.shape != (len(cell_names), len(gene_names)):
+        raise ValueError('matrix shape {} does not match {} cells x {} genes'.format(X.shape,
+                                                                                    len(cell_names),
+                                                                                    len(gene_names)))
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    # indices and indptr share one dtype so scipy can wrap them without a cast
+    idx_dtype = np.int32 if max(X.nnz, X.shape[1]) < np.iinfo(np.int32).max else np.int64
+    _replace_write('{}/data.npy'.format(store_dir), lambda f: np.save(f, X.data))
+    _replace_write('{}/indices.npy'.format(store_dir), lambda f: np.save(f, X.indices.astype(idx_dtype)))
+    _replace_write('{}/indptr.npy'.format(store_dir), lambda f: np.save(f, X.indptr.astype(idx_dtype)))
+    _replace_write('{}/genes.txt'.format(store_dir), lambda f: f.write(('\n'.join(gene_names) + '\n').encode()))
+    _replace_write('{}/cells.txt'.format(store_dir), lambda f: f.write(('\n'.join(cell_names) + '\n').encode()))
+
+def load_counts_store(store_dir, mmap=True):
+    # Open a counts store written by save_counts_store
+    # Input: dir + memory-map the arrays (read-only, pages shared between kernels) or read them into memory
+    # Output: (sparse csr cell x gene, list of gene names, list of cell names)
+    mmap_mode = 'r' if mmap == True else None
+    data = np.load('{}/data.npy'.format(store_dir), mmap_mode=mmap_mode)
+    indices = np.load('{}/indices.npy'.format(store_dir), mmap_mode=mmap_mode)
+    indptr = np.load('{}/indptr.npy'.format(store_dir), mmap_mode=mmap_mode)
+    with open('{}/genes.txt'.format(store_dir)) as f:
+        gene_names = f.read().splitlines()
+    with open('{}/cells.txt'.format(store_dir)) as f:
+        cell_names = f.read().splitlines()
+
+    X = sparse.csr_matrix((data, indices, indptr),
+                          shape=(len(indptr)-1, len(gene_names)),
+                          copy=False)
+    return X, gene_names, cell_names
+
+def counts_store_exists(store_dir):
+    return all(os.path.exists('{}/{}'.format(store_dir, x))
+               for x in ['data.npy', 'indices.npy', 'indptr.npy', 'genes.txt', 'cells.txt'])
+
+def create_adata_store (store_dir, csv_path=None, chunksize=2000, dtype=None):
+    # Creates adata obj from a counts store, building the store from the counts CSV on first use
+    # Input: store dir + gene x cell CSV (only read if store missing or older) + optional X dtype
+        # dtype = dtype the store is kept in (an existing store is converted once, not on every load)
+    # Output: adata obj; X is memory-mapped
+    if csv_path is not None:
+        stale = (not counts_store_exists(store_dir) or
+                 os.path.getmtime(csv_path) > os.path.getmtime('{}/indptr.npy'.format(store_dir)))
+        if stale:
+            X, gene_names, cell_names = stream_counts_csr(csv_path, chunksize=chunksize,
+                                                          dtype=np.int32 if dtype is None else dtype)
+            save_counts_store(store_dir, X, gene_names, cell_names)
+            del X
+
+    data_path = '{}/data.npy'.format(store_dir)
+    if dtype is not None and np.load(data_path, mmap_mode='r').dtype != np.dtype(dtype):
+        data = np.load(data_path, mmap_mode='r')
+        _replace_write(data_path, lambda f: np.save(f, data.astype(dtype)))
+        del data
+
+    print('Ingest raw data (store)...')
+    X, gene_names, cell_names = load_counts_store(store_dir)
+
+    adata = ad.AnnData(X=X,
+                       obs=pd.DataFrame(index=cell_names),
+                       var=pd.DataFrame({'gene_symbols':gene_names}, index=gene_names),
+                       dtype=X.dtype)
+
+    # summary
+    sum_output (adata)
+
+    return adata
+
+def _count_file_stats(file_list):
+    # size and mtime (ns) for each count file, used to detect new/changed files
+    stats_list = [os.stat(x) for x in file_list]
+    return pd.DataFrame({'path':file_list,
+                         'size':[x.st_size for x in stats_list],
+                         'mtime':[x.st_mtime_ns for x in stats_list]})
+
+def merge_counts_incremental(top_dir, store_dir, ncores=None, chunksize=64):
+    # Append only new or changed HTSeq tables to a persisted merged counts matrix
+    # Input: top dir of count files (globbed as merge_counts) + dir holding the merged store
+    # Output: (sparse csr cell x gene int32, list of gene names, list of cell names); store updated on disk
+    # store_dir contents: counts store (see save_counts_store) + manifest.csv (path,size,mtime,cell)
+
+    manifest_path = '{}/manifest.csv'.format(store_dir)
+
+    file_list = [filename for filename in glob.iglob(top_dir + '**/*.txt', recursive=True)]
+    current = _count_file_stats(file_list)
+
+    if os.path.exists(manifest_path):
+        manifest = pd.read_csv(manifest_path, dtype={'path':str, 'size':np.int64,
+                                                     'mtime':np.int64, 'cell':str})
+        X, gene_names, cell_names = load_counts_store(store_dir)
+        if cell_names != manifest['cell'].tolist():
+            raise ValueError('{} is out of sync with the counts store'.format(manifest_path))
+    else:
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        manifest = current.iloc[:0].assign(cell=pd.Series([], dtype=str))
+        X = None
+        gene_names = None
+
+    # compare against manifest on (path, size, mtime)
+    # nullable ints so ns mtimes survive the left join without a float cast
+    joined = pd.merge(current,
+                      manifest.astype({'size':'Int64', 'mtime':'Int64'}),
+                      'left', 'path', suffixes=('', '_old'))
+    is_new = joined['cell'].isnull().values
+    for col in ['size_old', 'mtime_old']:
+        joined[col] = joined[col].fillna(-1).astype(np.int64)
+    is_changed = (~is_new) & ((joined['size'] != joined['size_old']).values |
+                              (joined['mtime'] != joined['mtime_old']).values)
+    todo = joined[is_new | is_changed]
+    print('{} new, {} changed, {} unchanged count files'.format(is_new.sum(),
+                                                                is_changed.sum(),
+                                                                len(joined) - len(todo)))
+    if len(todo) == 0:
+        return X, gene_names, manifest['cell'].tolist()
+
+    new_X, new_genes, _ = merge_counts_sparse(top_dir, ncores=ncores, chunksize=chunksize,
+                                              file_list=todo['path'].tolist())
+    if gene_names is not None and new_genes != gene_names:
+        raise ValueError('gene order of new count files differs from {}/genes.txt'.format(store_dir))
+
+    # changed files keep their cell name; their old rows are dropped and re-appended
+    keep_rows = ~manifest['path'].isin(todo['path']).values
+    kept = manifest[keep_rows]
+    new_cells = todo['cell'].values.astype(object)
+    new_cells[is_new[is_new | is_changed]] = count_file_names(todo['path'][todo['cell'].isnull()].tolist(),
+                                                              existing=manifest['cell'].tolist())
+    if X is not None:
+        X = sparse.vstack([X[np.flatnonzero(keep_rows)], new_X], format='csr')
+    else:
+        X = new_X
+    manifest = pd.concat([kept,
+                          pd.DataFrame({'path':todo['path'].values,
+                                        'size':todo['size'].values,
+                                        'mtime':todo['mtime'].values,
+                                        'cell':new_cells})],
+                         ignore_index=True)
+
+    # manifest goes last so it only ever lists rows that are in the store
+    save_counts_store(store_dir, X, new_genes, manifest['cell'].tolist())
+    _replace_write(manifest_path, lambda f: f.write(manifest.to_csv(index=False).encode()))
+
+    return X, new_genes, manifest['cell'].tolist()
+
+def write_synthetic_counts(out_dir, n_cells=1000, n_genes=20000, density=0.1, n_plates=4, seed=0):
+    # Write fake HTSeq count files (incl. __ metadata rows) for benchmarking
+    # Input: output dir + matrix shape/density
+    # Output: list of written file paths
+    rng = np.random.RandomState(seed)
+    genes = ['GENE{}'.format(x) for x in range(n_genes)]
+    meta = ['__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique']
+    file_list = []
+    for cell in range(n_cells):
+        plate = 'B{:06d}'.format(cell % n_plates)
+        plate_dir = '{}/{}'.format(out_dir, plate)
+        if not os.path.exists(plate_dir):
+            os.makedirs(plate_dir)
+        counts = rng.poisson(5, n_genes) * (rng.rand(n_genes) < density)
+        path = '{}/C{}_{}_S1.homo.htseq-count.txt'.format(plate_dir, cell, plate)
+        with open(path, 'w') as f:
+            f.write(''.join('{}\t{}\n'.format(g, c) for g, c in zip(genes, counts)))
+            f.write(''.join('{}\t{}\n'.format(m, rng.randint(1000)) for m in meta))
+        file_list.append(path)
+    return file_list
+
+def benchmark_merge_counts(out_dir, n_cells=1000, n_genes=20000, density=0.1, ncores=None, legacy=True):
+    # Compare merge_counts with merge_counts_sparse on synthetic count files
+    # Input: scratch dir + synthetic matrix settings
+    # Output: df of wall time, files/sec and result size per engine
+    file_list = write_synthetic_counts(out_dir, n_cells=n_cells, n_genes=n_genes, density=density)
+    top_dir = out_dir.rstrip('/') + '/'
+    results = []
+
+    start = time.time()
+    X, genes, cells = merge_counts_sparse(top_dir, ncores=ncores)
+    elapsed = time.time() - start
+    results.append({'engine':'merge_counts_sparse', 'seconds':elapsed,
+                    'files_per_sec':len(file_list)/elapsed,
+                    'MB':(X.data.nbytes + X.indices.nbytes + X.indptr.nbytes)/1e6})
+
+    if legacy == True:
+        start = time.time()
+        master_df = merge_counts(top_dir)
+        elapsed = time.time() - start
+        results.append({'engine':'merge_counts', 'seconds':elapsed,
+                        'files_per_sec':len(file_list)/elapsed,
+                        'MB':master_df.memory_usage(deep=False).sum()/1e6})
+
+        # same counts either way
+        dense = master_df.set_index('gene').values
+        if not np.array_equal(dense.T, X.toarray()):
+            raise AssertionError('merge engines disagree')
+
+    return pd.DataFrame(results)
+
+def synthetic_pcs(n_cells, n_dims=30, n_clusters=40, seed=0):
+    # Gaussian clusters w/ PCA-like decaying variance per dimension, for kNN benchmarks
+    rng = np.random.RandomState(seed)
+    sd = np.exp(-np.arange(n_dims) / 6.)
+    centers = rng.normal(0, 4, (n_clusters, n_dims)) * sd
+    return (centers[rng.randint(0, n_clusters, n_cells)] + rng.normal(size=(n_cells, n_dims)) * sd).astype(np.float32)
+
+def benchmark_knn(n_cells=(10000, 100000), n_dims=30, n_neighbors=30, settings=((2,1), (4,2), (8,3)), seed=0):
+    # Compare approx_knn recall + wall time against exact sklearn kNN on synthetic_pcs data
+    # Input: cell counts + (n_trees, n_iters) settings to sweep
+    # Output: df of seconds, recall (fraction of exact neighbors found) and speedup per setting
+    results = []
+    for n in n_cells:
+        X = synthetic_pcs(n, n_dims=n_dims, seed=seed)
+
+        start = time.time()
+        _, exact_idx = NearestNeighbors(n_neighbors=n_neighbors).fit(X).kneighbors(X)
+        exact_time = time.time() - start
+        results.append({'n_cells':n, 'method':'exact', 'n_trees':None, 'n_iters':None,
+                        'seconds':exact_time, 'recall':1.0, 'speedup':1.0})
+
+        exact_sorted = np.sort(exact_idx, axis=1)
+        for n_trees, n_iters in settings:
+            start = time.time()
+            idx, _ = approx_knn(X, n_neighbors=n_neighbors, n_trees=n_trees, n_iters=n_iters, random_state=seed)
+            elapsed = time.time() - start
+            # per-row overlap of sorted neighbor sets
+            hits = [len(np.intersect1d(a, b, assume_unique=True)) for a, b in zip(np.sort(idx, axis=1), exact_sorted)]
+            results.append({'n_cells':n, 'method':'approx', 'n_trees':n_trees, 'n_iters':n_iters,
+                            'seconds':elapsed, 'recall':np.mean(hits)/n_neighbors,
+                            'speedup':exact_time/elapsed})
+        print('{} cells done'.format(n))
+
+    return pd.DataFrame(results)
+
 def true_age_exp(gene, input_adata):
     groupby = 'patient'
     var_names = [gene]
@@ -22,11 +22,11 @@ from sklearn.cluster import AgglomerativeClustering, KMeans
 from scipy.cluster import hierarchy
 from sklearn import preprocessing
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import f1_score, roc_auc_score, jaccard_similarity_score
+from sklearn.metrics import f1_score, roc_auc_score
 from IPython.core.display import HTML
 import numpy.ma as ma # masking package
 import statsmodels.api as sm
-import subprocess, os, sys, mygene, string, glob, typing, random, pickle, tqdm, itertools
+import subprocess, os, sys, mygene, string, glob, typing, random, pickle, tqdm, itertools, time, sqlite3
 import s3fs
 import boto3
 from lifelines.statistics import logrank_test
@@ -237,10 +237,26 @@ def regress(x, y, predictor, fit_intercept = False):
     
     return y_predicted.flatten(), y_residuals.flatten()
 
-def get_s3path_list(bucket, prefix, suffix):
+def get_s3path_list(bucket, prefix, suffix, manifest_path=None, refresh=False, max_age=None, incremental=False):
     #     bucket = 'darmanis-group'
     #     prefix = 'singlecell_lungadeno/rawdata/fastqs'
     #     suffix = 'fastq.gz'
+    # manifest_path: answer from a local S3ListingManifest without listing S3; the prefix is fully listed
+    #     on first use, when refresh=True, or when its last full listing is older than max_age seconds
+    # incremental: refresh by listing only keys after the last stored key (misses new keys that sort earlier)
+
+    if manifest_path is not None:
+        manifest = S3ListingManifest(manifest_path)
+        last_full = manifest.last_full_refresh(bucket, prefix)
+        if (refresh == True or last_full is None or
+                (max_age is not None and time.time() - last_full > max_age)):
+            if incremental == True and last_full is not None:
+                warnings.warn('incremental refresh only finds keys after the last stored key for {}/{}; '
+                              'new keys sorting earlier are missing until a full refresh'.format(bucket, prefix))
+                manifest.refresh(bucket, prefix)
+            else:
+                manifest.refresh(bucket, prefix, full=True)
+        return manifest.paths(bucket, prefix, suffix)
 
     client = boto3.client('s3')
     paginator = client.get_paginator('list_objects')
@@ -250,6 +266,131 @@ def get_s3path_list(bucket, prefix, suffix):
     paths = ['s3://{}/{}'.format(bucket, key['Key']) for page in page_iterator for key in page['Contents'] if key['Key'].endswith(suffix)]
     return paths
 
+class S3ListingManifest:
+    """
+    local SQLite cache of S3 listings (key, size, ETag) for prefix/suffix queries without re-listing
+
+    refresh() lists with list_objects_v2 starting after the last key stored for that prefix,
+    so new keys sorting after it (new runs/plates) cost one short listing;
+    full=True re-lists the prefix and also picks up rewritten and deleted keys
+    (last_full_refresh() gives its time, for max-age checks)
+    """
+    def __init__(self, db_path, client=None):
+        self.db_path = db_path
+        self.client = client
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS listings (
+                bucket TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                last_key TEXT,
+                refreshed REAL,
+                PRIMARY KEY (bucket, prefix)
+            );
+            CREATE TABLE IF NOT EXISTS full_listings (
+                bucket TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                refreshed REAL,
+                PRIMARY KEY (bucket, prefix)
+            );
+        """)
+
+    def _client(self):
+        if self.client is None:
+            self.client = boto3.client('s3')
+        return self.client
+
+    def refresh(self, bucket, prefix='', full=False):
+        # Update cached keys under s3://bucket/prefix
+        # Input: bucket + prefix + full re-list flag
+        # Output: number of keys listed
+        row = self.conn.execute('SELECT last_key FROM listings WHERE bucket=? AND prefix=?',
+                                (bucket, prefix)).fetchone()
+        start_after = None if (full == True or row is None) else row[0]
+        if full == True:
+            # listing resets, rows not seen again are deleted below
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM seen')
+
+        params = {'Bucket':bucket, 'Prefix':prefix}
+        if start_after is not None:
+            params['StartAfter'] = start_after
+
+        start = time.time()
+        n_listed = 0
+        last_key = start_after
+        while True:
+            page = self._client().list_objects_v2(**params)
+            rows = [(bucket, x['Key'], x['Size'], x['ETag'].strip('"'), str(x.get('LastModified')))
+                    for x in page.get('Contents', [])]
+            if len(rows) > 0:
+                self.conn.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?)', rows)
+                if full == True:
+                    self.conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(x[1],) for x in rows])
+                n_listed += len(rows)
+                last_key = max(last_key, rows[-1][1]) if last_key is not None else rows[-1][1]
+            if full != True:
+                # checkpoint per page so an interrupted refresh resumes where it stopped
+                self.conn.execute('INSERT OR REPLACE INTO listings VALUES (?,?,?,?)',
+                                  (bucket, prefix, last_key, time.time()))
+                self.conn.commit()
+            if not page.get('IsTruncated'):
+                break
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+        if full == True:
+            lower, upper = self._key_range(prefix)
+            self.conn.execute('DELETE FROM objects WHERE bucket=? AND key>=? AND key<? '
+                              'AND key NOT IN (SELECT key FROM seen)', (bucket, lower, upper))
+            self.conn.execute('INSERT OR REPLACE INTO listings VALUES (?,?,?,?)',
+                              (bucket, prefix, last_key, time.time()))
+            self.conn.execute('INSERT OR REPLACE INTO full_listings VALUES (?,?,?)',
+                              (bucket, prefix, time.time()))
+            self.conn.commit()
+
+        print('Listed {} keys under s3://{}/{} in {:.1f}s'.format(n_listed, bucket, prefix, time.time()-start))
+        return n_listed
+
+    def last_full_refresh(self, bucket, prefix=''):
+        # time.time() of the last full listing of exactly this prefix (None if never)
+        row = self.conn.execute('SELECT refreshed FROM full_listings WHERE bucket=? AND prefix=?',
+                                (bucket, prefix)).fetchone()
+        return None if row is None else row[0]
+
+    def _key_range(self, prefix):
+        # [lower, upper) key range covering every key that starts with prefix (uses the primary key index)
+        if prefix == '':
+            return '', '\U0010ffff'
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def query(self, bucket, prefix='', suffix=''):
+        # Cached objects under prefix whose key ends with suffix
+        # Output: df with paths (s3://...), key, size, etag
+        lower, upper = self._key_range(prefix)
+        sql = 'SELECT key, size, etag FROM objects WHERE bucket=? AND key>=? AND key<?'
+        params = [bucket, lower, upper]
+        if suffix != '':
+            sql += ' AND substr(key, -?) = ?'
+            params += [len(suffix), suffix]
+        df = pd.DataFrame(self.conn.execute(sql + ' ORDER BY key', params).fetchall(),
+                          columns=['key', 'size', 'etag'])
+        df.insert(0, 'paths', ['s3://{}/{}'.format(bucket, x) for x in df['key']])
+        return df
+
+    def paths(self, bucket, prefix='', suffix=''):
+        return self.query(bucket, prefix, suffix)['paths'].tolist()
+
+    def close(self):
+        self.conn.close()
+
 def well_series_test(cluster, input_adata):
     contam_cells = input_adata.obs[input_adata.obs.louvain == cluster]
     return_df = pd.DataFrame()